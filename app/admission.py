@@ -0,0 +1,169 @@
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from typing import AsyncGenerator, Deque, Optional, Tuple
+from loguru import logger
+from metrics import REJECTED_REQUESTS, STREAMS_ACTIVE, STREAMS_WAITING, observe_stage
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Overloaded ({reason}), retry after {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """
+    Token bucket per client: a client can send burst questions at once, then rate questions
+    per second. The buckets of the least recently seen clients are dropped above max_clients,
+    a dropped bucket is full again, so memory stays bounded whatever the number of clients.
+    """
+
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        """
+        :param rate: Tokens added to a bucket per second. 0 disables the limit.
+        :param burst: Capacity of a bucket.
+        :param max_clients: Maximum number of buckets kept in memory.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        # client -> (tokens, last update)
+        self.buckets: OrderedDict[str, Tuple[float, float]] = OrderedDict()
+
+    def acquire(self, client: str) -> float:
+        """
+        Take a token from the bucket of a client.
+
+        :return: 0 if the request is allowed, else the seconds until a token is available.
+        """
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.pop(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self.buckets[client] = (tokens, now)
+        while len(self.buckets) > self.max_clients:
+            self.buckets.popitem(last=False)
+        return wait
+
+
+class StreamLimiter:
+    """
+    Bound the number of answers generated at once, so a traffic spike queues or is rejected
+    instead of exceeding the Mistral rate limits and slowing down every answer.
+
+    A question takes a slot before its generation starts. When all the slots are taken it
+    waits in a FIFO queue of at most max_waiting questions, for at most max_wait seconds.
+    A question that can't be queued or waits too long fails fast with Overloaded, whose
+    retry_after estimates when a slot frees up from the average duration of the answers.
+    """
+
+    def __init__(self, max_streams: int, max_waiting: int, max_wait: float):
+        """
+        :param max_streams: Maximum number of answers generated at once.
+        :param max_waiting: Maximum number of questions waiting for a slot.
+        :param max_wait: Maximum seconds a question waits for a slot.
+        """
+        self.max_streams = max(max_streams, 1)
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.average_duration: Optional[float] = None
+
+    def retry_after(self) -> float:
+        if self.average_duration is None:
+            return max(self.max_wait, 1.0)
+        # The waiting questions, this one included, share the slots freed by the answers
+        wait = self.average_duration * (len(self.waiters) + 1) / self.max_streams
+        return float(max(math.ceil(wait), 1))
+
+    def update_gauges(self):
+        STREAMS_ACTIVE.set(self.active)
+        STREAMS_WAITING.set(len(self.waiters))
+
+    def reject(self, reason: str):
+        REJECTED_REQUESTS.inc(reason=reason)
+        retry_after = self.retry_after()
+        logger.warning(
+            f"Question rejected ({reason}): {self.active} answers, "
+            f"{len(self.waiters)} waiting, retry after {retry_after:.0f}s"
+        )
+        raise Overloaded(reason, retry_after)
+
+    async def acquire(self):
+        """
+        Take a slot, waiting in the queue if needed.
+
+        :raises Overloaded: If the queue is full, or the slot wasn't available in time.
+        """
+        if self.active < self.max_streams and not self.waiters:
+            self.active += 1
+            self.update_gauges()
+            return
+        if len(self.waiters) >= self.max_waiting:
+            self.reject("queue_full")
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.update_gauges()
+        start_time = time.perf_counter()
+        try:
+            # release() hands its slot over by resolving the future
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            self.reject("queue_timeout")
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over while this question was cancelled
+                self.release()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            self.update_gauges()
+        observe_stage("queue", time.perf_counter() - start_time)
+
+    def release(self, duration: Optional[float] = None):
+        """
+        Give the slot to the first waiting question, or free it.
+
+        :param duration: Seconds the slot was held, to estimate the Retry-After.
+        """
+        if duration is not None:
+            self.average_duration = (
+                duration
+                if self.average_duration is None
+                else 0.9 * self.average_duration + 0.1 * duration
+            )
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.update_gauges()
+                return
+        self.active -= 1
+        self.update_gauges()
+
+    async def limit(
+        self, chunks: AsyncGenerator[str, None]
+    ) -> AsyncGenerator[str, None]:
+        """
+        Stream the chunks of an answer while holding a slot, taken before the generation
+        starts and released when the stream ends, is cancelled or fails.
+        """
+        await self.acquire()
+        start_time = time.perf_counter()
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self.release(time.perf_counter() - start_time)
+            await chunks.aclose()
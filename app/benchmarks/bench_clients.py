@@ -0,0 +1,185 @@
+"""
+Client pooling benchmark: loads many domains and sends a Qdrant request and an embedding
+request per domain, concurrently, to a local fake server that emulates both APIs.
+Reports the request latency and the number of sockets opened by the process.
+
+--clients per-domain builds a Qdrant and two Mistral clients per domain (old behaviour),
+--clients shared uses the process-wide clients of clients.py. Each mode runs in its own
+process so their sockets are counted separately.
+
+    python benchmarks/bench_clients.py --domains 100 --clients per-domain shared
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+
+
+def api_handler(latency: float):
+    class ApiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive connections
+
+        def reply(self, payload: dict):
+            time.sleep(latency)
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # Qdrant: list the collections
+            self.reply({"result": {"collections": []}, "status": "ok", "time": 0})
+
+        def do_POST(self):
+            # Mistral: embeddings
+            self.rfile.read(int(self.headers["Content-Length"]))
+            self.reply(
+                {
+                    "id": "bench",
+                    "object": "list",
+                    "model": "mistral-embed",
+                    "data": [
+                        {"object": "embedding", "embedding": [0.1] * 1024, "index": 0}
+                    ],
+                    "usage": {
+                        "prompt_tokens": 1,
+                        "total_tokens": 1,
+                        "completion_tokens": 0,
+                    },
+                }
+            )
+
+        def log_message(self, *args):
+            pass
+
+    return ApiHandler
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # all the domains connect at the same time
+
+
+def open_sockets() -> int:
+    sockets = 0
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            sockets += os.readlink(f"/proc/self/fd/{fd}").startswith("socket:")
+        except OSError:
+            pass  # the fd of the listing itself
+    return sockets
+
+
+def build_clients(domains: int, mode: str, port: int) -> list:
+    """
+    :return: A (async Qdrant client, embedding Mistral client) pair per domain.
+    """
+    import httpx
+    from mistralai import Mistral
+    from qdrant_client import AsyncQdrantClient, QdrantClient
+
+    server_url = f"http://127.0.0.1:{port}"
+    if mode == "shared":
+        import clients
+
+        return [
+            (clients.get_async_qdrant_client(), clients.get_mistral_client())
+            for _ in range(domains)
+        ]
+    pairs = []
+    for _ in range(domains):
+        # Default keep-alive pool, like a client of a remote Qdrant host
+        QdrantClient(host="127.0.0.1", port=port, limits=httpx.Limits())
+        aclient = AsyncQdrantClient(host="127.0.0.1", port=port, limits=httpx.Limits())
+        embeddings = Mistral(api_key="benchmark", server_url=server_url)
+        Mistral(api_key="benchmark", server_url=server_url)  # the chat client
+        pairs.append((aclient, embeddings))
+    return pairs
+
+
+async def request(aclient, mistral, latencies: list):
+    start_time = time.perf_counter()
+    await aclient.get_collections()
+    await mistral.embeddings.create_async(model="mistral-embed", inputs=["question"])
+    latencies.append(time.perf_counter() - start_time)
+
+
+async def run(domains: int, mode: str, port: int, rounds: int):
+    os.environ["QDRANT_HOST"] = "127.0.0.1"
+    os.environ["QDRANT_PORT"] = str(port)
+    os.environ["MISTRAL_SERVER_URL"] = f"http://127.0.0.1:{port}"
+
+    start_time = time.perf_counter()
+    pairs = build_clients(domains, mode, port)
+    build_time = time.perf_counter() - start_time
+
+    latencies: list = []
+    peak_sockets = 0
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(
+            *[request(aclient, mistral, latencies) for aclient, mistral in pairs]
+        )
+        peak_sockets = max(peak_sockets, open_sockets())
+    elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    print(
+        f"{mode:>10}: {domains} domains loaded in {build_time:.2f}s, "
+        f"p50 {latencies[len(latencies) // 2] * 1000:.0f}ms, "
+        f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f}ms, "
+        f"{len(latencies) / elapsed:.0f} domain requests/s, {peak_sockets} open sockets"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--domains", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument(
+        "--clients",
+        nargs="+",
+        default=["per-domain", "shared"],
+        choices=["per-domain", "shared"],
+    )
+    parser.add_argument("--port", type=int, help="port of a running fake server")
+    args = parser.parse_args()
+
+    from loguru import logger
+
+    logger.remove()
+    if args.port:
+        asyncio.run(run(args.domains, args.clients[0], args.port, args.rounds))
+    else:
+        server = ApiServer(("127.0.0.1", 0), api_handler(args.latency))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        for mode in args.clients:
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--domains",
+                    str(args.domains),
+                    "--rounds",
+                    str(args.rounds),
+                    "--clients",
+                    mode,
+                    "--port",
+                    str(server.server_address[1]),
+                ],
+                check=True,
+            )
+        server.shutdown()
@@ -0,0 +1,58 @@
+"""
+Concurrency benchmark of the async chat path: runs many simultaneous ChatMistral.chat
+streams against a fake Mistral client and reports the throughput per concurrency level.
+
+With the async pipeline the wall time stays close to a single stream, so the throughput
+scales with the number of streams. --blocking emulates a synchronous retrieval step,
+which serializes the streams again.
+
+    python benchmarks/bench_concurrency.py --concurrency 1 10 50 100
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+os.environ.setdefault("PHOSPHO_API_KEY", "benchmark")
+os.environ.setdefault("PHOSPHO_PROJECT_ID", "benchmark")
+
+from loguru import logger  # noqa: E402
+
+from benchmarks.fakes import FakeEmbeddings, FakeMistral  # noqa: E402
+from models import ChatMistral  # noqa: E402
+
+
+async def consume(chat: ChatMistral, question: str) -> int:
+    tokens = 0
+    async for _ in chat.chat(question):
+        tokens += 1
+    return tokens
+
+
+async def run(concurrency: int, blocking: bool) -> float:
+    chat = ChatMistral(
+        "bench.example.com", embeddings=FakeEmbeddings(blocking=blocking)
+    )
+    chat.client = FakeMistral()
+    start_time = time.perf_counter()
+    await asyncio.gather(*[consume(chat, f"question {i}") for i in range(concurrency)])
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--blocking", action="store_true")
+    args = parser.parse_args()
+
+    logger.remove()
+    for concurrency in args.concurrency:
+        elapsed = asyncio.run(run(concurrency, args.blocking))
+        print(
+            f"{concurrency:>5} streams: {elapsed:.2f}s wall, {concurrency / elapsed:.1f} streams/s"
+        )
@@ -0,0 +1,135 @@
+"""
+Crawl benchmark: serves a synthetic site locally and crawls it with TextContentSpider,
+reporting the pages/sec. Embeddings are computed by a mock model, so no API is called.
+
+The pages share navigation and footer sentences, like a real website, which exercises
+the duplicate-sentence check of chunk_text. --dedup compares the sentence hash index with
+the previous scan of every stored page (each mode runs in its own process, as the Twisted
+reactor cannot be restarted).
+
+    python benchmarks/bench_crawl.py --pages 5000 --dedup index legacy
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(APP_PATH)
+os.chdir(APP_PATH)  # get_project_settings looks for scrapy.cfg in the working directory
+
+os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+
+
+def site_handler(pages: int):
+    class SiteHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/":
+                body = "".join(
+                    f'<a href="/page_{i}">Page {i}</a> ' for i in range(pages)
+                )
+            else:
+                i = self.path.rsplit("_", 1)[-1]
+                body = (
+                    "Home. Products. Pricing. Contact us. "
+                    + " ".join(
+                        f"Sentence {j} is only on page {i} of the website."
+                        for j in range(20)
+                    )
+                    + " Copyright 2024 Benchmark Inc. All rights reserved."
+                )
+            content = f"<html><body>{body}</body></html>".encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    return SiteHandler
+
+
+def crawl(pages: int, dedup: str):
+    from llama_index.core.embeddings import MockEmbedding
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+
+    from scraper import TextContentSpider
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), site_handler(pages))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    domain = f"127.0.0.1:{server.server_port}"
+
+    class BenchmarkSpider(TextContentSpider):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.start_urls = [f"http://{domain}/"]
+            self.allowed_domains = ["127.0.0.1"]
+            self.embeddings_model = MockEmbedding(embed_dim=8)
+
+        def index_sentences(self, url: str, text: str):
+            super().index_sentences(url, text)
+            if not hasattr(self, "full_texts"):
+                self.full_texts = {}
+            self.full_texts[url] = text
+
+        def forget_sentences(self, url: str):
+            super().forget_sentences(url)
+            getattr(self, "full_texts", {}).pop(url, None)
+
+        def is_known_sentence(self, sentence: str) -> bool:
+            if dedup == "legacy":
+                # Previous implementation: substring scan of every stored page
+                return any(
+                    sentence in text
+                    for text in getattr(self, "full_texts", {}).values()
+                )
+            return super().is_known_sentence(sentence)
+
+    settings = get_project_settings()
+    settings.set("DOWNLOAD_DELAY", 0)
+    settings.set("ROBOTSTXT_OBEY", False)
+    settings.set("LOG_LEVEL", os.getenv("LOG_LEVEL", "ERROR"))
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(BenchmarkSpider)
+    process.crawl(crawler, domain=domain, depth=1, db_path=tempfile.mkdtemp())
+    start_time = time.perf_counter()
+    process.start()
+    elapsed = time.perf_counter() - start_time
+    crawled = crawler.stats.get_value("response_received_count", 0)
+    print(
+        f"{dedup:>6}: {crawled} pages in {elapsed:.1f}s, {crawled / elapsed:.1f} pages/s, "
+        f"{len(crawler.spider.database)} pages stored"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=5000)
+    parser.add_argument(
+        "--dedup", nargs="+", default=["index"], choices=["index", "legacy"]
+    )
+    args = parser.parse_args()
+
+    if len(args.dedup) == 1:
+        crawl(args.pages, args.dedup[0])
+    else:
+        for dedup in args.dedup:
+            subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--pages",
+                    str(args.pages),
+                    "--dedup",
+                    dedup,
+                ],
+                check=True,
+            )
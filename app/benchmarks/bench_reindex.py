@@ -0,0 +1,74 @@
+"""
+Benchmark of the incremental re-indexing: indexes a synthetic site, changes a few pages,
+removes a few others and times the second EmbeddingsVS.upload_embeddings.
+
+Runs fully offline with a local Qdrant and a mock embedding model.
+
+    python benchmarks/bench_reindex.py --pages 10000 --changed 10
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+os.environ.setdefault("PHOSPHO_API_KEY", "benchmark")
+os.environ.setdefault("PHOSPHO_PROJECT_ID", "benchmark")
+
+from llama_index.core.embeddings import MockEmbedding  # noqa: E402
+from loguru import logger  # noqa: E402
+from qdrant_client import QdrantClient  # noqa: E402
+
+from benchmarks.fakes import fake_page, write_domain  # noqa: E402
+from models import EmbeddingsVS  # noqa: E402
+
+
+class CountingEmbedding(MockEmbedding):
+    calls: int = 0
+
+    def _get_text_embeddings(self, texts):
+        self.calls += len(texts)
+        return super()._get_text_embeddings(texts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=10000)
+    parser.add_argument("--chunks", type=int, default=3)
+    parser.add_argument("--changed", type=int, default=10)
+    args = parser.parse_args()
+
+    logger.remove()
+    folder = tempfile.mkdtemp()
+    embeddings = EmbeddingsVS("bench.example.com")
+    embeddings.client = QdrantClient(path=os.path.join(folder, "qdrant"))
+    embeddings.embed_model = CountingEmbedding(embed_dim=256)
+    embeddings.domain_path = os.path.join(folder, "bench.example.com.json")
+
+    pages = [fake_page(embeddings.domain, i, args.chunks) for i in range(args.pages)]
+    write_domain(embeddings.domain_path, pages)
+    start_time = time.perf_counter()
+    embeddings.upload_embeddings()
+    print(
+        f"full index:        {time.perf_counter() - start_time:.2f}s, "
+        f"{embeddings.embed_model.calls} chunks embedded"
+    )
+
+    # Change the first pages and remove the last ones
+    embeddings.embed_model.calls = 0
+    for i in range(args.changed):
+        pages[i] = fake_page(embeddings.domain, i, args.chunks, version=1)
+    write_domain(embeddings.domain_path, pages[: len(pages) - args.changed])
+    start_time = time.perf_counter()
+    embeddings.upload_embeddings()
+    print(
+        f"incremental index: {time.perf_counter() - start_time:.2f}s, "
+        f"{embeddings.embed_model.calls} chunks embedded"
+    )
+    print(
+        f"points in collection: {embeddings.client.count(embeddings.vector_db_name).count}"
+    )
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of EmbeddingsVS.asearch: retriever rebuilt on every query (old behaviour)
+versus the retriever built once per domain.
+
+Runs fully offline with Qdrant in :memory: mode and a mock embedding model.
+
+    python benchmarks/bench_retriever.py --documents 200 --queries 200
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+os.environ.setdefault("PHOSPHO_API_KEY", "benchmark")
+os.environ.setdefault("PHOSPHO_PROJECT_ID", "benchmark")
+
+from llama_index.core.embeddings import MockEmbedding  # noqa: E402
+from qdrant_client import AsyncQdrantClient, QdrantClient  # noqa: E402
+
+from benchmarks.fakes import fake_page, write_domain  # noqa: E402
+from models import EmbeddingsVS  # noqa: E402
+
+
+async def copy_points(embeddings: EmbeddingsVS, documents: int):
+    # The two :memory: clients don't share their data
+    points, _ = embeddings.client.scroll(
+        embeddings.vector_db_name, limit=documents, with_vectors=True
+    )
+    collection = embeddings.client.get_collection(embeddings.vector_db_name)
+    await embeddings.aclient.create_collection(
+        embeddings.vector_db_name, vectors_config=collection.config.params.vectors
+    )
+    await embeddings.aclient.upsert(embeddings.vector_db_name, points=points)
+
+
+def build_embeddings(documents: int) -> EmbeddingsVS:
+    embeddings = EmbeddingsVS("bench.example.com")
+    embeddings.client = QdrantClient(location=":memory:")
+    embeddings.aclient = AsyncQdrantClient(location=":memory:")
+    embeddings.embed_model = MockEmbedding(embed_dim=1024)
+    # Measure the retriever alone, without the query caches
+    embeddings.embedding_cache.max_size = 0
+    embeddings.results_cache.max_size = 0
+    embeddings.domain_path = os.path.join(tempfile.mkdtemp(), "bench.example.com.json")
+    write_domain(
+        embeddings.domain_path,
+        [fake_page(embeddings.domain, i, chunks=1) for i in range(documents)],
+    )
+    embeddings.upload_embeddings()
+    asyncio.run(copy_points(embeddings, documents))
+    return embeddings
+
+
+async def run(embeddings: EmbeddingsVS, queries: int, rebuild: bool) -> float:
+    start_time = time.perf_counter()
+    for i in range(queries):
+        if rebuild:
+            embeddings.retriever = None  # force the per-query setup of the old code
+        await embeddings.asearch(f"question number {i}")
+    return (time.perf_counter() - start_time) / queries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    embeddings = build_embeddings(args.documents)
+    before = asyncio.run(run(embeddings, args.queries, rebuild=True))
+    after = asyncio.run(run(embeddings, args.queries, rebuild=False))
+    print(f"rebuild per query: {before * 1000:.3f} ms/query")
+    print(f"cached retriever:  {after * 1000:.3f} ms/query")
+    print(f"speedup:           {before / after:.2f}x")
@@ -0,0 +1,405 @@
+"""
+End-to-end load test of the FastAPI app, fully offline: /question_on_url is driven at
+several concurrency levels and the p50/p95/p99 time to first token, total latency and
+requests/s are reported.
+
+Three processes are started:
+- a fake Mistral API (chat completions streamed as server-sent events, with tool calls and
+  a configurable latency, and deterministic embeddings),
+- the app, served by uvicorn, with Qdrant in :memory: mode and a synthetic website indexed
+  through the fake API,
+- this process, the load generator.
+
+    python benchmarks/bench_server.py --concurrency 1 10 50 --requests 200 --mode tool retrieval
+
+With --sse the answers are requested as server-sent events, the reads/answer column shows
+the effect of their coalescing.
+
+The crawl throughput (pages/s through TextContentSpider) is measured by bench_crawl.py:
+
+    python benchmarks/bench_crawl.py --pages 5000 --dedup index legacy
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(APP_PATH)
+
+DOMAIN = "bench.example.com"
+DIMENSION = 1024
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def fake_embedding(text: str) -> list:
+    # Deterministic, and different for every text
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return [(seed[i % len(seed)] - 127.5) / 127.5 for i in range(DIMENSION)]
+
+
+def mistral_handler(first_token_latency: float, token_latency: float, tokens: int):
+    class MistralHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive connections
+
+        def send_json(self, payload: dict):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_event(self, payload):
+            data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n"
+            data = data.encode()
+            # Chunked transfer encoding, the connection is kept open
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(self, delta: dict, finish_reason=None) -> dict:
+            return {
+                "id": "bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "fake",
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+
+        def do_POST(self):
+            try:
+                request = json.loads(
+                    self.rfile.read(int(self.headers["Content-Length"]))
+                )
+            except ValueError:
+                return  # the request was cancelled while it was sent
+            if self.path.endswith("/embeddings"):
+                inputs = request["input"] if "input" in request else request["inputs"]
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                self.send_json(
+                    {
+                        "id": "bench",
+                        "object": "list",
+                        "model": "mistral-embed",
+                        "data": [
+                            {
+                                "object": "embedding",
+                                "embedding": fake_embedding(text),
+                                "index": i,
+                            }
+                            for i, text in enumerate(inputs)
+                        ],
+                        "usage": {
+                            "prompt_tokens": 1,
+                            "total_tokens": 1,
+                            "completion_tokens": 0,
+                        },
+                    }
+                )
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            time.sleep(first_token_latency)
+            if request.get("tools") and request.get("tool_choice") == "any":
+                # Search when forced to, answer once the results are there
+                question = request["messages"][-1]["content"]
+                tool_call = {
+                    "id": uuid.uuid4().hex[:9],
+                    "index": 0,
+                    "function": {
+                        "name": "search_context",
+                        "arguments": json.dumps({"query": question}),
+                    },
+                }
+                self.send_event(
+                    self.chunk({"role": "assistant", "tool_calls": [tool_call]})
+                )
+                self.send_event(self.chunk({"content": ""}, "tool_calls"))
+            else:
+                for i in range(tokens):
+                    if i:
+                        time.sleep(token_latency)
+                    self.send_event(self.chunk({"content": f"token{i} "}))
+                self.send_event(self.chunk({"content": ""}, "stop"))
+            self.send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, *args):
+            pass
+
+    return MistralHandler
+
+
+class MistralServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve_mistral(
+    port: int, first_token_latency: float, token_latency: float, tokens: int
+):
+    server = MistralServer(
+        ("127.0.0.1", port), mistral_handler(first_token_latency, token_latency, tokens)
+    )
+    server.serve_forever()
+
+
+def serve_app(port: int, mistral_port: int, pages: int):
+    """
+    Index the synthetic website through the fake API, then serve the app.
+    """
+    os.environ["URL"] = f"https://{DOMAIN}"
+    os.environ["SERVER_URL"] = f"http://127.0.0.1:{port}"
+    os.environ["MISTRAL_SERVER_URL"] = f"http://127.0.0.1:{mistral_port}"
+    os.environ["DOMAIN_STATE_DB_PATH"] = os.path.join("data", "domains.db")
+    os.environ["CHAT_LOG_SINK"] = "jsonl"  # offline
+
+    import uvicorn
+    from loguru import logger
+    from qdrant_client import AsyncQdrantClient, QdrantClient
+
+    from benchmarks.fakes import fake_page, write_domain
+
+    logger.remove()
+    os.makedirs("data", exist_ok=True)
+    write_domain(
+        os.path.join("data", f"{DOMAIN}.json"),
+        [fake_page(DOMAIN, i, chunks=2) for i in range(pages)],
+    )
+
+    import clients
+
+    clients.qdrant_client = QdrantClient(location=":memory:")
+    clients.async_qdrant_client = AsyncQdrantClient(location=":memory:")
+
+    import main
+    import models
+
+    # The two :memory: clients don't share their data: copy the indexed points
+    embeddings = models.EmbeddingsVS(DOMAIN)
+    embeddings.upload_embeddings()
+    points, _ = clients.qdrant_client.scroll(
+        embeddings.vector_db_name, limit=pages * 2, with_vectors=True
+    )
+    collection = clients.qdrant_client.get_collection(embeddings.vector_db_name)
+
+    async def copy():
+        await clients.async_qdrant_client.create_collection(
+            embeddings.vector_db_name, vectors_config=collection.config.params.vectors
+        )
+        await clients.async_qdrant_client.upsert(
+            embeddings.vector_db_name, points=points
+        )
+
+    asyncio.run(copy())
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def cpu_seconds(pid: int) -> float:
+    """
+    CPU time used by a process (only Linux is supported).
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def load(port: int, concurrency: int, requests: int, sse: bool = False) -> dict:
+    import httpx
+
+    ttfts, latencies, errors, reads = [], [], 0, 0
+    headers = {"Accept": "text/event-stream"} if sse else {}
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker(client: httpx.AsyncClient):
+        nonlocal errors, reads
+        while not queue.empty():
+            i = queue.get_nowait()
+            start_time = time.perf_counter()
+            ttft = None
+            try:
+                async with client.stream(
+                    "POST",
+                    "/question_on_url",
+                    json={"question": f"What is on page {i % 100}?"},
+                    headers=headers,
+                ) as response:
+                    response.raise_for_status()
+                    async for _ in response.aiter_raw():
+                        reads += 1
+                        if ttft is None:
+                            ttft = time.perf_counter() - start_time
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            ttfts.append(ttft)
+            latencies.append(time.perf_counter() - start_time)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=120
+    ) as client:
+        start_time = time.perf_counter()
+        await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start_time
+    ttfts.sort()
+    latencies.sort()
+    return {
+        "ttfts": ttfts,
+        "latencies": latencies,
+        "errors": errors,
+        "reads": reads,
+        "rps": len(latencies) / elapsed,
+    }
+
+
+def wait_for(port: int, process: subprocess.Popen, timeout: float = 120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The app exited during its startup")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--mode", nargs="+", default=["tool", "retrieval"])
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument(
+        "--sse",
+        action="store_true",
+        help="ask for server-sent events instead of plain text",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the output of the app"
+    )
+    parser.add_argument("--phase", choices=["mistral", "app"])
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--mistral-port", type=int)
+    args = parser.parse_args()
+
+    if args.phase == "mistral":
+        serve_mistral(
+            args.port, args.first_token_latency, args.token_latency, args.tokens
+        )
+    elif args.phase == "app":
+        serve_app(args.port, args.mistral_port, args.pages)
+    else:
+        mistral_port = free_port()
+        environment = {**os.environ, "MISTRAL_API_KEY": "benchmark", "HTTP2": "false"}
+        # All the load comes from one client
+        environment.setdefault("QUESTION_RATE_LIMIT", "0")
+        mistral = subprocess.Popen(
+            [
+                sys.executable,
+                __file__,
+                "--phase",
+                "mistral",
+                "--port",
+                str(mistral_port),
+                "--first-token-latency",
+                str(args.first_token_latency),
+                "--token-latency",
+                str(args.token_latency),
+                "--tokens",
+                str(args.tokens),
+            ]
+        )
+        try:
+            wait_for(mistral_port, mistral)
+            for mode in args.mode:
+                port = free_port()
+                with tempfile.TemporaryDirectory() as workdir:
+                    app = subprocess.Popen(
+                        [
+                            sys.executable,
+                            os.path.abspath(__file__),
+                            "--phase",
+                            "app",
+                            "--port",
+                            str(port),
+                            "--mistral-port",
+                            str(mistral_port),
+                            "--pages",
+                            str(args.pages),
+                        ],
+                        cwd=workdir,
+                        env={
+                            **environment,
+                            "CHAT_MODE": mode,
+                            "RETRIEVAL_MIN_SCORE": "0",
+                        },
+                        stdout=None if args.verbose else subprocess.DEVNULL,
+                        stderr=None if args.verbose else subprocess.DEVNULL,
+                    )
+                    try:
+                        wait_for(port, app)
+                        for concurrency in args.concurrency:
+                            cpu = cpu_seconds(app.pid)
+                            result = asyncio.run(
+                                load(port, concurrency, args.requests, args.sse)
+                            )
+                            cpu = cpu_seconds(app.pid) - cpu
+                            if not result["latencies"]:
+                                print(
+                                    f"{mode:>10} x{concurrency:<4}: "
+                                    f"all {result['errors']} requests failed"
+                                )
+                                continue
+                            ttfts, latencies = result["ttfts"], result["latencies"]
+                            print(
+                                f"{mode:>10} x{concurrency:<4}: "
+                                f"TTFT p50 {percentile(ttfts, 0.5) * 1000:.0f}ms "
+                                f"p95 {percentile(ttfts, 0.95) * 1000:.0f}ms "
+                                f"p99 {percentile(ttfts, 0.99) * 1000:.0f}ms, "
+                                f"latency p50 {percentile(latencies, 0.5) * 1000:.0f}ms "
+                                f"p95 {percentile(latencies, 0.95) * 1000:.0f}ms "
+                                f"p99 {percentile(latencies, 0.99) * 1000:.0f}ms, "
+                                f"{result['rps']:.1f} requests/s, {result['errors']} errors, "
+                                f"{result['reads'] / len(latencies):.0f} reads/answer, "
+                                f"app CPU {cpu * 1000 / args.requests:.1f}ms/request"
+                            )
+                    finally:
+                        app.terminate()
+                        app.wait()
+        finally:
+            mistral.terminate()
+            mistral.wait()
@@ -0,0 +1,59 @@
+"""
+Time-to-first-token benchmark of the CHAT_MODE of ChatMistral, against a fake Mistral client.
+
+The tool mode pays two model latencies before the first token, the retrieval and parallel
+modes one when the search results are good enough. --score sets the similarity of the fake
+search results: below RETRIEVAL_MIN_SCORE the retrieval modes fall back to the tool mode.
+
+    python benchmarks/bench_ttft.py --modes tool retrieval parallel --score 0.9 0.5
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+os.environ.setdefault("MISTRAL_API_KEY", "benchmark")
+os.environ.setdefault("PHOSPHO_API_KEY", "benchmark")
+os.environ.setdefault("PHOSPHO_PROJECT_ID", "benchmark")
+
+from loguru import logger  # noqa: E402
+
+from benchmarks.fakes import FakeEmbeddings, FakeMistral  # noqa: E402
+from models import ChatMistral  # noqa: E402
+
+
+async def ttft(chat: ChatMistral, question: str) -> float:
+    start_time = time.perf_counter()
+    first_token = None
+    async for _ in chat.chat(question):
+        if first_token is None:
+            first_token = time.perf_counter() - start_time
+    return first_token
+
+
+async def run(mode: str, score: float, questions: int) -> list:
+    chat = ChatMistral("bench.example.com", embeddings=FakeEmbeddings(score=score))
+    chat.client = FakeMistral()
+    chat.mode = mode
+    return sorted([await ttft(chat, f"question {i}") for i in range(questions)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=["tool", "retrieval", "parallel"])
+    parser.add_argument("--score", type=float, nargs="+", default=[0.9, 0.5])
+    parser.add_argument("--questions", type=int, default=20)
+    args = parser.parse_args()
+
+    logger.remove()
+    for score in args.score:
+        for mode in args.modes:
+            latencies = asyncio.run(run(mode, score, args.questions))
+            print(
+                f"score {score:.2f} {mode:>10}: TTFT p50 {latencies[len(latencies) // 2] * 1000:.0f}ms, "
+                f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.0f}ms"
+            )
@@ -0,0 +1,201 @@
+"""
+Vector backend benchmark: the in-process LocalVectorIndex (float16 memmap, NumPy top-k)
+against Qdrant, on random 1024-dimension vectors.
+
+For each backend and number of chunks, the index is built in one process, then loaded and
+queried in a fresh one, which reports the load time, the resident memory added by the
+index and the search latency. Qdrant runs in local mode (QdrantClient(path=...)), or on a
+server with --qdrant-url, whose memory is then not measured.
+
+    python benchmarks/bench_vectors.py --chunks 1000 10000 50000 200000 --backends local qdrant
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np  # noqa: E402
+
+from domains import resident_memory_mb  # noqa: E402
+from vectors import LocalVectorIndex  # noqa: E402
+
+DIMENSION = 1024
+COLLECTION = "bench"
+
+
+def random_vectors(count: int, seed: int) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal(
+        (count, DIMENSION), dtype=np.float32
+    )
+
+
+def chunk(i: int) -> dict:
+    return {
+        "id": str(i),
+        "url": f"https://bench.example.com/page_{i // 4}",
+        "content_hash": "",
+        "text": f"Chunk {i} of the benchmark website. " * 25,
+    }
+
+
+def qdrant_client(path: str, url: str):
+    from qdrant_client import QdrantClient
+
+    return QdrantClient(url=url) if url else QdrantClient(path=path)
+
+
+def build(backend: str, chunks: int, path: str, url: str) -> float:
+    start_time = time.perf_counter()
+    if backend == "local":
+        vectors = np.concatenate(
+            [
+                random_vectors(min(10000, chunks - start), seed=start)
+                for start in range(0, chunks, 10000)
+            ]
+        )
+        index = LocalVectorIndex.build(
+            [chunk(i) for i in range(chunks)], vectors, max_float32_mb=0
+        )
+        index.save(os.path.join(path, "bench"))
+        return time.perf_counter() - start_time
+
+    from qdrant_client import models
+
+    client = qdrant_client(path, url)
+    if client.collection_exists(COLLECTION):
+        client.delete_collection(COLLECTION)
+    client.create_collection(
+        COLLECTION,
+        vectors_config=models.VectorParams(
+            size=DIMENSION, distance=models.Distance.COSINE
+        ),
+    )
+    for start in range(0, chunks, 10000):
+        vectors = random_vectors(min(10000, chunks - start), seed=start)
+        for batch in range(0, len(vectors), 1000):
+            client.upsert(
+                COLLECTION,
+                points=[
+                    models.PointStruct(
+                        id=str(uuid.UUID(int=start + i)),
+                        vector=vectors[i].tolist(),
+                        payload=chunk(start + i),
+                    )
+                    for i in range(batch, min(batch + 1000, len(vectors)))
+                ],
+            )
+    client.close()
+    return time.perf_counter() - start_time
+
+
+def serve(backend: str, path: str, url: str, queries: int, max_float32_mb: float):
+    memory = resident_memory_mb()
+    start_time = time.perf_counter()
+    if backend == "local":
+        index = LocalVectorIndex.load(os.path.join(path, "bench"), max_float32_mb)
+
+        def search(vector):
+            return index.search(vector, 5)
+
+    else:
+        client = qdrant_client(path, url)
+
+        def search(vector):
+            return client.query_points(COLLECTION, query=vector.tolist(), limit=5)
+
+    search(random_vectors(1, seed=2**32 - 1)[0])  # first query, part of the load
+    load_time = time.perf_counter() - start_time
+
+    latencies = []
+    for vector in random_vectors(queries, seed=2**31):
+        start_time = time.perf_counter()
+        search(vector)
+        latencies.append(time.perf_counter() - start_time)
+    latencies.sort()
+    added = resident_memory_mb() - memory if memory is not None and not url else None
+    return load_time, added, latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--chunks", type=int, nargs="+", default=[1000, 10000, 50000, 200000]
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["local", "qdrant"],
+        choices=["local", "qdrant"],
+    )
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument(
+        "--max-float32-mb",
+        type=float,
+        default=0,
+        help="LOCAL_VECTORS_FLOAT32_MB of the local backend",
+    )
+    parser.add_argument(
+        "--qdrant-url", help="url of a Qdrant server instead of the local mode"
+    )
+    parser.add_argument("--phase", choices=["build", "serve"])
+    parser.add_argument("--backend")
+    parser.add_argument("--path")
+    args = parser.parse_args()
+
+    from loguru import logger
+
+    logger.remove()
+    if args.phase == "build":
+        build_time = build(args.backend, args.chunks[0], args.path, args.qdrant_url)
+        print(f"{build_time:.2f}")
+    elif args.phase == "serve":
+        load_time, added, latencies = serve(
+            args.backend, args.path, args.qdrant_url, args.queries, args.max_float32_mb
+        )
+        print(
+            f"{load_time * 1000:.0f}ms load, "
+            f"{f'{added:.0f}MB' if added is not None else 'n/a'} memory, "
+            f"p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+            f"p99 {latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000:.1f}ms"
+        )
+    else:
+        for chunks in args.chunks:
+            for backend in args.backends:
+                with tempfile.TemporaryDirectory() as path:
+                    common = [
+                        "--backend",
+                        backend,
+                        "--path",
+                        path,
+                        "--chunks",
+                        str(chunks),
+                        "--queries",
+                        str(args.queries),
+                        "--max-float32-mb",
+                        str(args.max_float32_mb),
+                    ]
+                    if args.qdrant_url:
+                        common += ["--qdrant-url", args.qdrant_url]
+                    phases = {}
+                    for phase in ["build", "serve"]:
+                        phases[phase] = subprocess.run(
+                            [sys.executable, __file__, "--phase", phase] + common,
+                            check=True,
+                            capture_output=True,
+                            text=True,
+                        ).stdout.strip()
+                    size = sum(
+                        os.path.getsize(os.path.join(root, name))
+                        for root, _, names in os.walk(path)
+                        for name in names
+                    )
+                    print(
+                        f"{backend:>6} {chunks:>7} chunks: built in {phases['build']}s, "
+                        f"{size / 1024**2:.0f}MB on disk, {phases['serve']}"
+                    )
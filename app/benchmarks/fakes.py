@@ -0,0 +1,164 @@
+"""
+Local stand-ins for the Mistral chat client and the EmbeddingsVS of a domain, so that the
+chat path can be benchmarked without calling the real APIs.
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from typing import List, Optional
+
+from mistralai.models import (
+    CompletionChunk,
+    CompletionEvent,
+    CompletionResponseStreamChoice,
+    DeltaMessage,
+    FunctionCall,
+    ToolCall,
+)
+
+
+def completion_event(delta: DeltaMessage) -> CompletionEvent:
+    return CompletionEvent(
+        data=CompletionChunk(
+            id=str(uuid.uuid4()),
+            model="fake",
+            choices=[
+                CompletionResponseStreamChoice(index=0, delta=delta, finish_reason=None)
+            ],
+        )
+    )
+
+
+class FakeStream:
+    def __init__(self, deltas: List[DeltaMessage], latency: float):
+        self.deltas = deltas
+        self.latency = latency
+
+    def __aiter__(self):
+        return self.events()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def events(self):
+        for delta in self.deltas:
+            await asyncio.sleep(self.latency)
+            yield completion_event(delta)
+
+
+class FakeChat:
+    def __init__(
+        self,
+        first_token_latency: float,
+        token_latency: float,
+        tokens: int,
+        tool_calls: int,
+    ):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.tokens = tokens
+        self.tool_calls = tool_calls
+
+    async def stream_async(
+        self, messages, tools=None, tool_choice=None, **kwargs
+    ) -> FakeStream:
+        await asyncio.sleep(self.first_token_latency)
+        # Search when forced to, answer once the results are there
+        if tools and tool_choice == "any":
+            question = next(
+                m["content"] for m in reversed(messages) if isinstance(m, dict)
+            )
+            tool_calls = [
+                ToolCall(
+                    id=str(uuid.uuid4())[:9],
+                    function=FunctionCall(
+                        name="search_context",
+                        arguments=json.dumps({"query": f"{question} (search {i})"}),
+                    ),
+                )
+                for i in range(self.tool_calls)
+            ]
+            return FakeStream([DeltaMessage(content="", tool_calls=tool_calls)], 0)
+        deltas = [DeltaMessage(content=f"token{i} ") for i in range(self.tokens)]
+        return FakeStream(deltas, self.token_latency)
+
+
+class FakeMistral:
+    """Mimics the async streaming API of mistralai.Mistral with a configurable latency."""
+
+    def __init__(
+        self,
+        first_token_latency: float = 0.2,
+        token_latency: float = 0.005,
+        tokens: int = 50,
+        tool_calls: int = 1,
+    ):
+        self.chat = FakeChat(first_token_latency, token_latency, tokens, tool_calls)
+
+
+class FakeEmbeddings:
+    """Mimics EmbeddingsVS.asearch; blocking=True emulates a synchronous Qdrant search."""
+
+    def __init__(
+        self, latency: float = 0.05, blocking: bool = False, score: float = 0.9
+    ):
+        self.latency = latency
+        self.blocking = blocking
+        self.score = score
+
+    async def asearch(
+        self, query: str, failed_searches: Optional[List[str]] = None
+    ) -> List[dict]:
+        if self.blocking:
+            time.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+        return [
+            {
+                "id": str(i),
+                "text": f"context {i} for {query}",
+                "url": None,
+                "score": self.score,
+            }
+            for i in range(5)
+        ]
+
+
+def fake_page(domain: str, i: int, chunks: int, version: int = 0) -> dict:
+    """A page record in the format written by TextContentSpider."""
+    url = f"https://{domain}/page_{i}"
+    texts = [
+        f"Page {i} chunk {j} version {version} of the benchmark website. " * 10
+        for j in range(chunks)
+    ]
+    full_text = " ".join(texts)
+    return {
+        "url": url,
+        "id": str(uuid.uuid4()),
+        "full_text": full_text,
+        "content_hash": hashlib.sha256(full_text.encode("utf-8")).hexdigest(),
+        "chunked_text": {
+            "embeddings": [
+                {
+                    "chunk_text": url + ": " + text,
+                    "embedding": None,
+                    "id": str(uuid.uuid4()),
+                }
+                for text in texts
+            ]
+        },
+        "last_time_crawled": "",
+        "status": "200",
+    }
+
+
+def write_domain(path: str, pages: List[dict]):
+    """Write the pages to a data/{domain}.json file like the spider does."""
+    with open(path, "w") as f:
+        json.dump({"url": [], "time": "", "config": {}, "data": pages}, f)
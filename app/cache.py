@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+
+class TTLCache:
+    """
+    LRU cache whose entries also expire after a time to live.
+    Hits and misses are counted so the efficiency of the cache can be monitored.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        :param max_size: Maximum number of entries, the least recently used are evicted first.
+        :param ttl: Time to live of an entry in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, tuple] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+
+embedding_cache: Optional[TTLCache] = None
+
+
+def get_embedding_cache() -> TTLCache:
+    """
+    Get the process-wide cache of the query embeddings, keyed by the normalized query.
+    Every domain embeds its queries with the same model, so they share it. The embeddings
+    are stored as float32 arrays, 4KB each instead of about 33KB as a list of 1024 floats.
+    QUERY_CACHE_SIZE (default 1024) and QUERY_CACHE_TTL (default 3600) configure it.
+    """
+    global embedding_cache
+    if embedding_cache is None:
+        embedding_cache = TTLCache(
+            max_size=int(os.getenv("QUERY_CACHE_SIZE", 1024)),
+            ttl=float(os.getenv("QUERY_CACHE_TTL", 3600)),
+        )
+    return embedding_cache
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a query so that trivial variations (case, spacing) share the same cache entry.
+    """
+    return " ".join(query.lower().split())
+
+
+class SemanticAnswerCache:
+    """
+    Cache of answers keyed by the embedding of the question.
+    A question is a hit when its cosine similarity with a cached question is above the threshold,
+    so paraphrases of frequent questions reuse the same answer.
+    Answers are tagged with the index version of the domain and expire when it is re-indexed.
+    """
+
+    def __init__(self, max_size: int, ttl: float, threshold: float):
+        """
+        :param max_size: Maximum number of answers, the least recently used are evicted first.
+        :param ttl: Time to live of an answer in seconds.
+        :param threshold: Minimum cosine similarity between two questions to reuse an answer.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries: OrderedDict[int, tuple] = OrderedDict()
+        self.next_key = 0
+        # Matrix of the normalized question embeddings, rebuilt lazily after a change
+        self.matrix: Optional[np.ndarray] = None
+        self.matrix_keys: List[int] = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, embedding: List[float], index_version: int) -> Optional[str]:
+        query = np.array(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self.lock:
+            if self.entries and self.matrix is None:
+                self.matrix_keys = list(self.entries.keys())
+                self.matrix = np.stack([self.entries[k][2] for k in self.matrix_keys])
+            answer = None
+            if self.entries:
+                similarities = self.matrix @ query
+                # The matches from the most similar, the expired ones are evicted on the way
+                # (the others are dropped by set)
+                matches = np.flatnonzero(similarities >= self.threshold)
+                expired = []
+                for i in matches[np.argsort(-similarities[matches])]:
+                    key = self.matrix_keys[i]
+                    if self.is_valid(self.entries[key], index_version):
+                        self.entries.move_to_end(key)
+                        answer = self.entries[key][3]
+                        break
+                    expired.append(key)
+                for key in expired:
+                    del self.entries[key]
+                if expired:
+                    self.matrix = None
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return answer
+
+    def set(self, embedding: List[float], index_version: int, answer: str):
+        if self.max_size <= 0:
+            return
+        vector = np.array(embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        with self.lock:
+            self.expire(index_version)
+            self.entries[self.next_key] = (
+                time.monotonic(),
+                index_version,
+                vector,
+                answer,
+            )
+            self.next_key += 1
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def is_valid(self, entry: tuple, index_version: int) -> bool:
+        created_at, version, _, _ = entry
+        return version == index_version and time.monotonic() - created_at <= self.ttl
+
+    def expire(self, index_version: int):
+        """
+        Drop the answers that are too old or that were generated from a previous index.
+        """
+        expired = [
+            key
+            for key, entry in self.entries.items()
+            if not self.is_valid(entry, index_version)
+        ]
+        for key in expired:
+            del self.entries[key]
+        if expired:
+            self.matrix = None
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
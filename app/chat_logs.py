@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from typing import Deque, List, Optional
+from loguru import logger
+from metrics import CHAT_LOG_QUEUE, CHAT_LOGS
+
+
+class JSONLSink:
+    """
+    Append the logs to a local JSON lines file, for offline use.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def send(self, batch: List[dict]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a") as f:
+            f.writelines(
+                json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch
+            )
+
+
+class PhosphoSink:
+    """
+    Send the logs to phospho. phospho is initialized with the first batch, not when the app
+    is imported, and its own thread then posts the logs, retried with a backoff.
+    While phospho holds more than max_pending logs (its backend is down), the batches are
+    refused, so the logs wait in the bounded ChatLogQueue instead of piling up in memory.
+    """
+
+    def __init__(self, max_pending: int = 1000):
+        self.max_pending = max_pending
+        self.initialized = False
+
+    def send(self, batch: List[dict]):
+        import phospho
+
+        if not self.initialized:
+            phospho.init()
+            self.initialized = True
+        pending = len(phospho.log_queue.events)
+        if pending > self.max_pending:
+            raise RuntimeError(f"{pending} logs not sent to phospho yet")
+        for entry in batch:
+            if entry.get("metadata"):
+                phospho.log(
+                    input=entry["input"],
+                    output=entry["output"],
+                    metadata=entry["metadata"],
+                )
+            else:
+                phospho.log(input=entry["input"], output=entry["output"])
+        phospho.flush()
+
+
+class ChatLogQueue:
+    """
+    Log the questions and answers without delaying the chat: log() only appends them to a
+    bounded in-memory queue, and a background task sends them to the sink (phospho or a JSON
+    lines file) in batches, every flush_interval seconds or as soon as a batch is full.
+    The sink runs in a thread, and while it fails the batches are retried with a backoff.
+
+    When the queue is full, the new logs are dropped, or with the "spill" policy appended to
+    a file, which is read back once the sink works again.
+    """
+
+    def __init__(
+        self,
+        sink,
+        max_size: int = 1000,
+        batch_size: int = 50,
+        flush_interval: float = 1,
+        overflow: str = "drop",
+        spill_path: Optional[str] = None,
+    ):
+        """
+        :param sink: An object with a blocking send(batch) method, which raises if it fails.
+        :param max_size: Maximum number of logs kept in memory.
+        :param batch_size: Maximum number of logs sent at once.
+        :param flush_interval: Seconds between two flushes of an incomplete batch.
+        :param overflow: "drop" or "spill" the logs when the queue is full.
+        :param spill_path: The JSON lines file of the spilled logs.
+        """
+        self.sink = sink
+        self.max_size = max_size
+        self.batch_size = max(batch_size, 1)
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.entries: Deque[dict] = deque()
+        self.batch_ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def log(self, input: str, output: str, metadata: Optional[dict] = None):
+        entry = {
+            "input": input,
+            "output": output,
+            "metadata": metadata,
+            "timestamp": time.time(),
+        }
+        if len(self.entries) >= self.max_size:
+            self.discard([entry])
+            return
+        self.entries.append(entry)
+        CHAT_LOG_QUEUE.set(len(self.entries))
+        if len(self.entries) >= self.batch_size:
+            self.batch_ready.set()
+
+    def discard(self, entries: List[dict]):
+        """
+        Spill or drop the logs that don't fit in the queue.
+        """
+        if self.overflow == "spill" and self.spill_path:
+            try:
+                JSONLSink(self.spill_path).send(entries)
+                self.spilled += len(entries)
+                CHAT_LOGS.inc(len(entries), status="spilled")
+                return
+            except OSError as e:
+                logger.error(f"Failed to spill the chat logs: {str(e)}")
+        self.dropped += len(entries)
+        CHAT_LOGS.inc(len(entries), status="dropped")
+        logger.warning(f"{len(entries)} chat logs dropped")
+
+    def read_spilled(self) -> List[dict]:
+        # Logs spilled while this file is read go to a new one
+        replayed = f"{self.spill_path}.replay"
+        os.replace(self.spill_path, replayed)
+        entries = []
+        with open(replayed, "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping a corrupted spilled chat log")
+        os.remove(replayed)
+        return entries
+
+    async def replay(self):
+        """
+        Move the spilled logs back to the queue, as many as fit.
+        """
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        entries = await asyncio.to_thread(self.read_spilled)
+        if not entries:
+            return
+        room = max(self.max_size - len(self.entries), 0)
+        self.entries.extend(entries[:room])
+        CHAT_LOG_QUEUE.set(len(self.entries))
+        if entries[room:]:
+            await asyncio.to_thread(JSONLSink(self.spill_path).send, entries[room:])
+        logger.info(f"Replaying {min(room, len(entries))} spilled chat logs")
+
+    async def flush(self) -> bool:
+        """
+        Send all the queued logs, batch by batch.
+
+        :return: False if the sink failed, its batch is then back at the front of the queue.
+        """
+        while self.entries:
+            batch = [
+                self.entries.popleft()
+                for _ in range(min(self.batch_size, len(self.entries)))
+            ]
+            try:
+                await asyncio.to_thread(self.sink.send, batch)
+            except Exception as e:
+                logger.warning(f"Failed to send {len(batch)} chat logs: {str(e)}")
+                # Logs added during the send may have filled the queue
+                room = max(self.max_size - len(self.entries), 0)
+                self.entries.extendleft(reversed(batch[:room]))
+                if batch[room:]:
+                    self.discard(batch[room:])
+                CHAT_LOG_QUEUE.set(len(self.entries))
+                return False
+            self.sent += len(batch)
+            CHAT_LOGS.inc(len(batch), status="sent")
+            CHAT_LOG_QUEUE.set(len(self.entries))
+        return True
+
+    async def run(self):
+        """
+        Flush the queue until cancelled, see close.
+        """
+        failures = 0
+        while True:
+            if failures:
+                await asyncio.sleep(min(self.flush_interval * 2**failures, 60))
+            else:
+                try:
+                    await asyncio.wait_for(self.batch_ready.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.batch_ready.clear()
+            try:
+                if await self.flush():
+                    failures = 0
+                    await self.replay()
+                else:
+                    failures += 1
+            except Exception as e:
+                logger.error(f"Failed to flush the chat logs: {str(e)}")
+                failures += 1
+
+    async def close(self, timeout: float = 5):
+        """
+        Send the last logs at shutdown. Those not sent within timeout seconds are spilled or
+        dropped.
+        """
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        if self.entries:
+            self.discard(list(self.entries))
+            self.entries.clear()
+            CHAT_LOG_QUEUE.set(0)
+
+    def stats(self) -> dict:
+        return {
+            "queued": len(self.entries),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+        }
+
+
+chat_log: Optional[ChatLogQueue] = None
+
+
+def get_chat_log() -> ChatLogQueue:
+    """
+    Get the process-wide chat log queue, configured with environment variables:
+    - CHAT_LOG_SINK: "phospho" (default) or "jsonl"
+    - CHAT_LOG_PATH: the file of the jsonl sink (default data/chat_logs.jsonl)
+    - CHAT_LOG_QUEUE_SIZE: maximum number of logs waiting to be sent (default 1000)
+    - CHAT_LOG_BATCH_SIZE: maximum number of logs sent at once (default 50)
+    - CHAT_LOG_FLUSH_INTERVAL: seconds between two flushes (default 1)
+    - CHAT_LOG_OVERFLOW: "drop" (default) or "spill" the logs when the queue is full
+    - CHAT_LOG_SPILL_PATH: the file of the spilled logs (default data/chat_logs.spill.jsonl)
+    """
+    global chat_log
+    if chat_log is None:
+        max_size = int(os.getenv("CHAT_LOG_QUEUE_SIZE", 1000))
+        if os.getenv("CHAT_LOG_SINK", "phospho") == "jsonl":
+            path = os.getenv("CHAT_LOG_PATH", os.path.join("data", "chat_logs.jsonl"))
+            logger.info(f"Logging the chats to {path}")
+            sink = JSONLSink(path)
+        else:
+            sink = PhosphoSink(max_pending=max_size)
+        chat_log = ChatLogQueue(
+            sink,
+            max_size=max_size,
+            batch_size=int(os.getenv("CHAT_LOG_BATCH_SIZE", 50)),
+            flush_interval=float(os.getenv("CHAT_LOG_FLUSH_INTERVAL", 1)),
+            overflow=os.getenv("CHAT_LOG_OVERFLOW", "drop"),
+            spill_path=os.getenv(
+                "CHAT_LOG_SPILL_PATH", os.path.join("data", "chat_logs.spill.jsonl")
+            ),
+        )
+    return chat_log
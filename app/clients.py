@@ -0,0 +1,189 @@
+import os
+import threading
+import httpx
+from typing import Optional
+from loguru import logger
+from mistralai import Mistral
+from mistralai.utils import BackoffStrategy, RetryConfig
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from llama_index.embeddings.mistralai import MistralAIEmbedding
+from metrics import UPSTREAM_RETRIES
+
+
+# Process-wide clients, shared by the EmbeddingsVS and ChatMistral of all the domains,
+# so the number of connections doesn't grow with the number of domains
+qdrant_client: Optional[QdrantClient] = None
+async_qdrant_client: Optional[AsyncQdrantClient] = None
+mistral_client: Optional[Mistral] = None
+embed_model: Optional[MistralAIEmbedding] = None
+# Domains are loaded in threads, the clients must be created only once
+lock = threading.Lock()
+
+
+def use_http2() -> bool:
+    """
+    HTTP/2 multiplexes the concurrent requests on a few connections. It needs the h2 package
+    (pip install "httpx[http2]"), HTTP/1.1 keep-alive connections are used without it.
+    """
+    if os.getenv("HTTP2", "true").lower() != "true":
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("h2 is not installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def http_limits(pool_size: int) -> httpx.Limits:
+    # Keep the pools moderate: httpcore scans every connection of the pool on each request,
+    # a pool of hundreds of connections is slower than a few busy ones
+    return httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=float(os.getenv("KEEPALIVE_EXPIRY", 60)),
+    )
+
+
+def qdrant_settings() -> dict:
+    """
+    Settings of the Qdrant clients, from environment variables:
+    - QDRANT_API_KEY and QDRANT_LOCATION: connect to Qdrant cloud
+    - QDRANT_HOST, QDRANT_PORT: else the local instance (default qdrant:6333)
+    - QDRANT_GRPC: "true" to use the gRPC transport (QDRANT_GRPC_PORT, default 6334)
+    - QDRANT_POOL_SIZE: maximum number of REST connections (default 20)
+    """
+    if os.getenv("QDRANT_API_KEY") and os.getenv("QDRANT_LOCATION"):
+        settings = {
+            "api_key": os.getenv("QDRANT_API_KEY"),
+            "location": os.getenv("QDRANT_LOCATION"),
+            # HTTP/2 is negotiated with TLS, the local instance is reached with plain HTTP
+            "http2": use_http2(),
+        }
+    else:
+        settings = {
+            "host": os.getenv("QDRANT_HOST", "qdrant"),
+            "port": int(os.getenv("QDRANT_PORT", 6333)),
+        }
+    settings["prefer_grpc"] = os.getenv("QDRANT_GRPC", "false").lower() == "true"
+    settings["grpc_port"] = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+    settings["limits"] = http_limits(int(os.getenv("QDRANT_POOL_SIZE", 20)))
+    return settings
+
+
+def connect_qdrant(client_class):
+    """
+    :param client_class: QdrantClient or AsyncQdrantClient.
+    :return: The client, or None if the connection failed.
+    """
+    settings = qdrant_settings()
+    logger.info(
+        f"Connecting to Qdrant {'cloud' if 'api_key' in settings else 'local'}"
+        f"{' with gRPC' if settings['prefer_grpc'] else ''}"
+    )
+    try:
+        return client_class(**settings)
+    except Exception as e:
+        logger.error(f"Failed to connect to Qdrant: {str(e)}")
+        logger.error(f"QDRANT_LOCATION: {os.getenv('QDRANT_LOCATION')}")
+        return None
+
+
+def get_qdrant_client() -> Optional[QdrantClient]:
+    global qdrant_client
+    with lock:
+        if qdrant_client is None:
+            qdrant_client = connect_qdrant(QdrantClient)
+    return qdrant_client
+
+
+def get_async_qdrant_client() -> Optional[AsyncQdrantClient]:
+    global async_qdrant_client
+    with lock:
+        if async_qdrant_client is None:
+            async_qdrant_client = connect_qdrant(AsyncQdrantClient)
+    return async_qdrant_client
+
+
+# Statuses retried by the Mistral client
+RETRIED_STATUSES = {429, 500, 502, 503, 504}
+
+
+def count_retry(response: httpx.Response):
+    if response.status_code in RETRIED_STATUSES:
+        UPSTREAM_RETRIES.inc(upstream="mistral")
+
+
+async def acount_retry(response: httpx.Response):
+    count_retry(response)
+
+
+def get_mistral_client() -> Mistral:
+    """
+    Get the process-wide Mistral client. Its sync and async HTTP clients keep a pool of
+    MISTRAL_POOL_SIZE (default 20) keep-alive connections, over HTTP/2 if available.
+    MISTRAL_SERVER_URL overrides the API endpoint, e.g. for a local fake server.
+    With MISTRAL_RETRY_MAX_ELAPSED seconds (default 0: no retries), rate limited (429) and
+    failed (5xx) requests are retried with an exponential backoff during that time. An answer
+    holds its StreamLimiter slot while its requests are retried.
+    """
+    global mistral_client
+    with lock:
+        if mistral_client is None:
+            limits = http_limits(int(os.getenv("MISTRAL_POOL_SIZE", 20)))
+            http2 = use_http2()
+            max_elapsed = float(os.getenv("MISTRAL_RETRY_MAX_ELAPSED", 0))
+            retries = max_elapsed > 0
+            mistral_client = Mistral(
+                api_key=os.getenv("MISTRAL_API_KEY"),
+                server_url=os.getenv("MISTRAL_SERVER_URL"),
+                client=httpx.Client(
+                    http2=http2,
+                    limits=limits,
+                    event_hooks={"response": [count_retry] if retries else []},
+                ),
+                async_client=httpx.AsyncClient(
+                    http2=http2,
+                    limits=limits,
+                    event_hooks={"response": [acount_retry] if retries else []},
+                ),
+                retry_config=RetryConfig(
+                    "backoff",
+                    BackoffStrategy(500, 5000, 2.0, int(max_elapsed * 1000)),
+                    retry_connection_errors=True,
+                )
+                if retries
+                else None,
+            )
+    return mistral_client
+
+
+def get_embed_model() -> MistralAIEmbedding:
+    """
+    Get the process-wide embedding model, which sends its requests with the shared Mistral client.
+    """
+    global embed_model
+    client = get_mistral_client()
+    with lock:
+        if embed_model is None:
+            embed_model = MistralAIEmbedding(
+                model_name="mistral-embed", api_key=os.getenv("MISTRAL_API_KEY")
+            )
+            # Replace the client created by MistralAIEmbedding with the pooled one
+            embed_model._client = client
+    return embed_model
+
+
+async def close_clients():
+    """
+    Close the connections of the shared clients, at shutdown.
+    """
+    global qdrant_client, async_qdrant_client, mistral_client, embed_model
+    if async_qdrant_client is not None:
+        await async_qdrant_client.close()
+    if qdrant_client is not None:
+        qdrant_client.close()
+    if mistral_client is not None:
+        await mistral_client.sdk_configuration.async_client.aclose()
+        mistral_client.sdk_configuration.client.close()
+    qdrant_client = async_qdrant_client = mistral_client = embed_model = None
@@ -0,0 +1,81 @@
+import re
+from typing import List, Set, Tuple
+from loguru import logger
+
+
+def text_tokens(text: str) -> int:
+    """
+    Rough token count of a text (about 4 characters per token for Mistral tokenizers).
+    """
+    return len(text) // 4
+
+
+def words(text: str) -> Set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def similarity(a: Set[str], b: Set[str]) -> float:
+    """
+    Jaccard similarity of the words of two chunks. The search results don't carry their
+    vectors, and the words are enough to spot shared navigation text and overlapping pages.
+    """
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def relevance(result: dict) -> float:
+    # The fused score of the hybrid search, else the dense similarity
+    return result.get("rrf_score", result.get("score")) or 0.0
+
+
+def pack_context(
+    results: List[dict],
+    max_tokens: int,
+    dedup_threshold: float = 0.8,
+    mmr_lambda: float = 0.7,
+) -> Tuple[List[dict], int]:
+    """
+    Select the search results sent to the model: near-duplicates are dropped, the others are
+    ranked by maximal marginal relevance (relevant to the query, different from the chunks
+    already selected) and added while they fit in the token budget.
+
+    :param results: The search results, with their text and score (or rrf_score).
+    :param max_tokens: Token budget of the context.
+    :param dedup_threshold: Similarity above which a chunk is a duplicate of a selected one.
+    :param mmr_lambda: Weight of the relevance against the diversity, 1 ranks by score only.
+    :return: The selected results, in selection order, and the number of tokens saved.
+    """
+    total_tokens = sum(text_tokens(r["text"]) for r in results)
+    candidates = [(r, words(r["text"])) for r in results if r.get("text")]
+    selected: List[Tuple[dict, Set[str]]] = []
+    tokens = 0
+    while candidates:
+        best, best_value, best_redundancy = None, None, 0.0
+        for i, (result, result_words) in enumerate(candidates):
+            redundancy = max(
+                (similarity(result_words, other) for _, other in selected), default=0.0
+            )
+            value = mmr_lambda * relevance(result) - (1 - mmr_lambda) * redundancy
+            if best_value is None or value > best_value:
+                best, best_value, best_redundancy = i, value, redundancy
+        result, result_words = candidates.pop(best)
+        if best_redundancy >= dedup_threshold:
+            continue
+        result_tokens = text_tokens(result["text"])
+        if tokens + result_tokens > max_tokens:
+            if selected:
+                continue  # a smaller chunk may still fit
+            # Always keep the most relevant chunk, truncated to the budget
+            result = {**result, "text": result["text"][: max_tokens * 4]}
+            result_tokens = text_tokens(result["text"])
+        selected.append((result, result_words))
+        tokens += result_tokens
+
+    saved = total_tokens - tokens
+    if results:
+        logger.info(
+            f"Context packing: {len(results)} -> {len(selected)} chunks, "
+            f"{tokens} prompt tokens, {saved} saved"
+        )
+    return [result for result, _ in selected], saved
@@ -0,0 +1,238 @@
+import os
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+from loguru import logger
+
+
+# Allowed transitions: status -> the statuses it can be reached from (None: unknown domain)
+TRANSITIONS = {
+    "queued": {None, "completed", "failed", "cancelled"},
+    "processing": {"queued"},
+    # Also from queued when a re-indexing is cancelled before it starts
+    "completed": {"queued", "processing"},
+    "failed": {"queued", "processing"},
+    "cancelled": {"queued", "processing"},
+}
+
+
+class DomainStateStore:
+    """
+    Indexing status of every domain, shared by all the workers of the host.
+
+    Status changes are atomic transitions (queued -> processing -> completed / failed), so two
+    workers can't both start indexing a domain. Every change bumps a version, and workers
+    poll changes(since) to pick up the domains indexed by the other workers.
+    A domain is indexed once it was completed, and stays so while it is indexed again: its
+    previous index keeps answering the questions.
+    A queued or processing domain is leased by the store instance that changed it last:
+    the instance renews the lease with heartbeat, and recover releases the domains of the
+    instances that stopped renewing it (the PID can't tell, it is reused by a restarted
+    container).
+    Backed by a SQLite database in WAL mode: reads don't block the writer.
+    """
+
+    def __init__(self, path: str, lease_ttl: float = 60):
+        """
+        :param path: Path of the SQLite database file.
+        :param lease_ttl: Seconds after the last heartbeat after which a domain is released.
+        """
+        self.path = path
+        self.lease_ttl = lease_ttl
+        # Owner of the leases, unique to this process run
+        self.instance_id = f"{os.getpid()}-{uuid.uuid4().hex}"
+        # Autocommit mode, the transitions open their own write transactions
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=30
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS domains (
+                domain TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                error TEXT,
+                owner TEXT,
+                updated_at REAL NOT NULL,
+                version INTEGER NOT NULL,
+                indexed INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(domains)")
+        ]
+        if "indexed" not in columns:
+            # Database created before the indexed flag
+            self.connection.execute(
+                "ALTER TABLE domains ADD COLUMN indexed INTEGER NOT NULL DEFAULT 0"
+            )
+            self.connection.execute(
+                "UPDATE domains SET indexed = 1 WHERE status = 'completed'"
+            )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS domains_version ON domains (version)"
+        )
+        self.lock = threading.Lock()
+
+    def get(self, domain: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT status FROM domains WHERE domain = ?", (domain,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def all(self) -> Dict[str, str]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain, status FROM domains"
+            ).fetchall()
+        return dict(rows)
+
+    def errors(self) -> Dict[str, str]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain, error FROM domains WHERE error IS NOT NULL"
+            ).fetchall()
+        return dict(rows)
+
+    def indexed(self) -> Set[str]:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain FROM domains WHERE indexed = 1"
+            ).fetchall()
+        return {domain for domain, in rows}
+
+    def version(self) -> int:
+        with self.lock:
+            row = self.connection.execute("SELECT MAX(version) FROM domains").fetchone()
+        return row[0] or 0
+
+    def changes(self, since: int) -> Tuple[int, Dict[str, Tuple[str, bool]]]:
+        """
+        :param since: The version returned by the previous call, 0 the first time.
+        :return: The current version, and the status and indexed flag of the domains changed
+            after since.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain, status, indexed, version FROM domains WHERE version > ? ORDER BY version",
+                (since,),
+            ).fetchall()
+        version = rows[-1][3] if rows else since
+        return version, {
+            domain: (status, bool(indexed)) for domain, status, indexed, _ in rows
+        }
+
+    def transition(self, domain: str, status: str, error: Optional[str] = None) -> bool:
+        """
+        Atomically change the status of a domain, if allowed from its current status.
+
+        :return: True if the status changed, False if another worker changed it first
+            or the transition isn't allowed.
+        """
+        allowed = TRANSITIONS[status]
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT status, indexed FROM domains WHERE domain = ?", (domain,)
+                ).fetchone()
+                current = row[0] if row else None
+                if current not in allowed:
+                    self.connection.execute("ROLLBACK")
+                    return False
+                indexed = status == "completed" or bool(row and row[1])
+                self.connection.execute(
+                    """
+                    INSERT OR REPLACE INTO domains (domain, status, error, owner, updated_at, version, indexed)
+                    VALUES (?, ?, ?, ?, ?, (SELECT COALESCE(MAX(version), 0) + 1 FROM domains), ?)
+                    """,
+                    (domain, status, error, self.instance_id, time.time(), indexed),
+                )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        logger.debug(f"Domain {domain}: {current} -> {status}")
+        return True
+
+    def heartbeat(self):
+        """
+        Renew the lease of the domains queued or processing by this instance.
+        """
+        with self.lock:
+            self.connection.execute(
+                "UPDATE domains SET updated_at = ? WHERE owner = ? AND status IN ('queued', 'processing')",
+                (time.time(), self.instance_id),
+            )
+
+    def recover(self) -> List[str]:
+        """
+        Release the domains left queued or processing by an instance whose lease expired,
+        so they can be queued again: an indexed domain is completed again, the others are
+        failed.
+
+        :return: The released domains.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT domain, indexed FROM domains WHERE status IN ('queued', 'processing') AND (owner IS NULL OR owner != ?) AND updated_at < ?",
+                (self.instance_id, time.time() - self.lease_ttl),
+            ).fetchall()
+        recovered = []
+        for domain, indexed in rows:
+            if indexed:
+                released = self.transition(domain, "completed")
+            else:
+                released = self.transition(domain, "failed", "interrupted")
+            if released:
+                recovered.append(domain)
+        return recovered
+
+    def import_statuses(self, statuses: Dict[str, str]):
+        """
+        Import the statuses of the previous domain_status.json, only into an empty store.
+        """
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            if self.connection.execute("SELECT COUNT(*) FROM domains").fetchone()[0]:
+                self.connection.execute("ROLLBACK")
+                return
+            for version, (domain, status) in enumerate(statuses.items(), start=1):
+                status, _, error = status.partition(": ")
+                self.connection.execute(
+                    "INSERT INTO domains (domain, status, error, owner, updated_at, version, indexed) VALUES (?, ?, ?, NULL, ?, ?, ?)",
+                    (
+                        domain,
+                        status,
+                        error or None,
+                        time.time(),
+                        version,
+                        status == "completed",
+                    ),
+                )
+            self.connection.execute("COMMIT")
+        logger.info(f"Imported the status of {len(statuses)} domains")
+
+
+domain_state_store: Optional[DomainStateStore] = None
+
+
+def get_domain_state_store() -> DomainStateStore:
+    """
+    Get the process-wide domain state store, configured with environment variables:
+    - DOMAIN_STATE_DB_PATH: path of the SQLite database (default data/domains.db)
+    - DOMAIN_LEASE_TTL: seconds without heartbeat after which the queued or processing
+      domains of a stopped worker are released (default 60)
+    """
+    global domain_state_store
+    if domain_state_store is None:
+        path = os.getenv("DOMAIN_STATE_DB_PATH", os.path.join("data", "domains.db"))
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        domain_state_store = DomainStateStore(
+            path, lease_ttl=float(os.getenv("DOMAIN_LEASE_TTL", 60))
+        )
+    return domain_state_store
@@ -0,0 +1,132 @@
+import gc
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+from loguru import logger
+
+
+def resident_memory_mb() -> Optional[float]:
+    """
+    Resident memory of the process in MB, or None if it can't be read (only Linux is supported).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+class DomainRegistry:
+    """
+    Lazily built engines of the served domains.
+
+    The engine of a domain is built on its first question, and the least recently used engines
+    are evicted when there are more than max_domains, when the process uses more than
+    max_memory_mb, or when they have been idle for more than ttl seconds.
+    So a server can host many websites while only the active ones are kept in memory.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], object],
+        max_domains: int,
+        ttl: float,
+        max_memory_mb: Optional[float] = None,
+    ):
+        """
+        :param factory: Build the engine of a domain. It is blocking, so it runs in a thread.
+        :param max_domains: Maximum number of engines kept in memory.
+        :param ttl: Idle time in seconds after which an engine is evicted.
+        :param max_memory_mb: Evict engines when the resident memory of the process is above this limit.
+        """
+        self.factory = factory
+        self.max_domains = max_domains
+        self.ttl = ttl
+        self.max_memory_mb = max_memory_mb
+        self.engines: OrderedDict[str, Tuple[float, object]] = OrderedDict()
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def __contains__(self, domain: str) -> bool:
+        return domain in self.engines
+
+    def items(self):
+        return [(domain, engine) for domain, (_, engine) in self.engines.items()]
+
+    async def get(self, domain: str):
+        """
+        Get the engine of a domain, building it if it isn't loaded.
+        Concurrent questions to a domain being loaded wait for the same build.
+        """
+        entry = self.engines.get(domain)
+        if entry is None:
+            lock = self.locks.setdefault(domain, asyncio.Lock())
+            async with lock:
+                entry = self.engines.get(domain)
+                if entry is None:
+                    start = time.perf_counter()
+                    engine = await asyncio.to_thread(self.factory, domain)
+                    self.loads += 1
+                    logger.info(
+                        f"Loaded domain {domain} in {time.perf_counter() - start:.2f}s"
+                    )
+                    entry = (time.monotonic(), engine)
+            self.locks.pop(domain, None)
+        self.engines[domain] = (time.monotonic(), entry[1])
+        self.engines.move_to_end(domain)
+        self.evict(keep=domain)
+        return entry[1]
+
+    def invalidate(self, domain: str):
+        """
+        Drop the engine of a domain, e.g. after it was re-indexed. It is rebuilt on next use.
+        """
+        self.engines.pop(domain, None)
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """
+        Evict the least recently used engines above the count limit, and one more if the
+        process is above the memory limit (freed memory is not always given back to the OS,
+        so evicting until the limit is met could drop every engine).
+
+        :param keep: A domain that is never evicted, the one being served.
+        """
+        candidates = [domain for domain in self.engines if domain != keep]
+        evicted = candidates[: max(len(self.engines) - self.max_domains, 0)]
+        if self.max_memory_mb and len(evicted) < len(candidates):
+            memory = resident_memory_mb()
+            if memory is not None and memory > self.max_memory_mb:
+                logger.info(f"Memory above the limit of the domains: {memory:.0f}MB")
+                evicted.append(candidates[len(evicted)])
+        for domain in evicted:
+            del self.engines[domain]
+            logger.info(f"Evicted domain {domain}")
+        if evicted:
+            gc.collect()
+        self.evictions += len(evicted)
+        return len(evicted)
+
+    def evict_idle(self) -> int:
+        deadline = time.monotonic() - self.ttl
+        # Engines are ordered by last use, so idle ones are at the front
+        evicted = 0
+        while self.engines:
+            domain, (last_use, _) = next(iter(self.engines.items()))
+            if last_use > deadline:
+                break
+            del self.engines[domain]
+            evicted += 1
+        self.evictions += evicted
+        return evicted + self.evict()
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "loaded": len(self.engines),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "memory_mb": resident_memory_mb(),
+        }
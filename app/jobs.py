@@ -0,0 +1,205 @@
+import time
+import uuid
+import queue
+import asyncio
+import multiprocessing
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+from loguru import logger
+from pydantic import BaseModel
+
+
+class IndexingJob(BaseModel):
+    """
+    A crawl + index job of a domain, and its progress.
+    status: queued -> processing -> crawling -> indexing -> completed, or failed / cancelled
+    (cancelling while the worker of a cancelled job exits)
+    """
+
+    job_id: str
+    domain: str
+    status: str = "queued"
+    pages_crawled: int = 0
+    pages_pending: int = 0
+    chunks_embedded: int = 0
+    eta: Optional[float] = None
+    error: Optional[str] = None
+    submitted_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+def run_indexing_job(domain: str, depth: int, progress_queue):
+    """
+    Crawl and index a domain. Runs in its own worker process: the Twisted reactor of Scrapy
+    cannot be restarted, so every crawl needs a fresh process.
+    """
+    from models import EmbeddingsVS, ScraperInterface
+
+    try:
+        progress_queue.put({"status": "crawling"})
+        ScraperInterface(domain=domain, depth=depth).run_crawler(
+            progress=progress_queue.put
+        )
+        progress_queue.put({"status": "indexing", "pages_pending": 0, "eta": None})
+        EmbeddingsVS(domain).upload_embeddings()
+        progress_queue.put({"status": "completed"})
+    except Exception as e:
+        progress_queue.put({"status": "failed", "error": str(e)})
+        raise
+
+
+class JobScheduler:
+    """
+    Run indexing jobs in worker processes, with at most max_workers jobs at the same time.
+    The API server keeps serving chats while the jobs run.
+    Finished jobs are forgotten after retention seconds.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        depth: int,
+        on_change: Callable[[IndexingJob], Awaitable[None]],
+        poll_interval: float = 0.5,
+        retention: float = 86400,
+    ):
+        """
+        :param max_workers: Maximum number of jobs running in parallel.
+        :param depth: The depth of the crawls.
+        :param on_change: Called when the status of a job changes.
+        :param poll_interval: Seconds between two checks of the workers.
+        :param retention: Seconds a finished job stays listed.
+        """
+        self.max_workers = max_workers
+        self.depth = depth
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.jobs: OrderedDict[str, IndexingJob] = OrderedDict()
+        self.pending: List[str] = []
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        self.queues: Dict[str, multiprocessing.Queue] = {}
+        # spawn: don't fork the event loop and the clients of the API server
+        self.context = multiprocessing.get_context("spawn")
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        for process in self.processes.values():
+            process.kill()
+        for process in self.processes.values():
+            await asyncio.to_thread(process.join, 5)
+
+    def submit(self, domain: str) -> IndexingJob:
+        job = IndexingJob(
+            job_id=str(uuid.uuid4()), domain=domain, submitted_at=time.time()
+        )
+        self.jobs[job.job_id] = job
+        self.pending.append(job.job_id)
+        logger.info(f"Queued indexing job {job.job_id} for {domain}")
+        return job
+
+    def get(self, job_id: str) -> Optional[IndexingJob]:
+        return self.jobs.get(job_id)
+
+    def active_job(self, domain: str) -> Optional[IndexingJob]:
+        for job in self.jobs.values():
+            if job.domain == domain and job.finished_at is None:
+                return job
+        return None
+
+    async def cancel(self, job_id: str) -> Optional[IndexingJob]:
+        """
+        Cancel a job. Its worker is killed: Scrapy handles SIGTERM as a graceful stop, after
+        which the worker would still index the partial crawl. The job stays "cancelling", and
+        counts against max_workers, until poll sees the worker has exited.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job.finished_at is not None:
+            return job
+        if job_id in self.pending:
+            self.pending.remove(job_id)
+            await self.finish(job, "cancelled")
+            return job
+        process = self.processes.get(job_id)
+        if process is not None:
+            process.kill()
+            job.status = "cancelling"
+        return job
+
+    async def finish(self, job: IndexingJob, status: str, error: Optional[str] = None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+        logger.info(f"Indexing job {job.job_id} for {job.domain}: {status}")
+        await self.on_change(job)
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+                self.prune()
+            except Exception as e:
+                logger.error(f"Failed to poll the indexing jobs: {str(e)}")
+            await asyncio.sleep(self.poll_interval)
+
+    def prune(self):
+        """
+        Forget the jobs finished more than retention seconds ago.
+        """
+        deadline = time.time() - self.retention
+        expired = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job.finished_at is not None and job.finished_at < deadline
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    async def poll(self):
+        # Update the progress of the running jobs
+        for job_id, process in list(self.processes.items()):
+            job = self.jobs[job_id]
+            alive = process.is_alive()
+            if job.status != "cancelling":
+                # The queue of a killed worker may hold a partial message
+                try:
+                    while True:
+                        for key, value in self.queues[job_id].get_nowait().items():
+                            setattr(job, key, value)
+                except queue.Empty:
+                    pass
+            if not alive:
+                del self.processes[job_id]
+                del self.queues[job_id]
+                if job.status == "cancelling":
+                    await self.finish(job, "cancelled")
+                elif job.status == "completed":
+                    await self.finish(job, "completed")
+                else:
+                    await self.finish(
+                        job,
+                        "failed",
+                        job.error or f"worker exited with code {process.exitcode}",
+                    )
+
+        # Start the queued jobs while there are free workers
+        while self.pending and len(self.processes) < self.max_workers:
+            job = self.jobs[self.pending.pop(0)]
+            progress_queue = self.context.Queue()
+            process = self.context.Process(
+                target=run_indexing_job,
+                args=(job.domain, self.depth, progress_queue),
+                daemon=True,
+            )
+            process.start()
+            self.processes[job.job_id] = process
+            self.queues[job.job_id] = progress_queue
+            job.status = "processing"
+            job.started_at = time.time()
+            await self.on_change(job)
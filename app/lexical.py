@@ -0,0 +1,137 @@
+import re
+import json
+import math
+import heapq
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Tuple
+from loguru import logger
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+    """
+    Local inverted index of the chunks of a domain, ranked with BM25.
+
+    Exact terms (product names, SKUs, error codes) are found even when their embedding is
+    not close to the one of the question, and the search needs no network call, so it is
+    also the fallback when the embedding API is slow or failing.
+    """
+
+    def __init__(self, chunks: List[dict], k1: float = 1.2, b: float = 0.75):
+        """
+        :param chunks: The chunks of the domain, with their id, url and text.
+        :param k1: Saturation of the term frequency.
+        :param b: Weight of the length normalization.
+        """
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        lengths = []
+        # term -> (chunk index, term frequency) of the chunks containing it
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        for i, chunk in enumerate(chunks):
+            tokens = tokenize(chunk["text"])
+            lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings[term].append((i, frequency))
+        average_length = sum(lengths) / len(lengths) if lengths else 1.0
+        # Length normalization of each chunk, computed once
+        self.norms = [
+            k1 * (1 - b + b * length / (average_length or 1.0)) for length in lengths
+        ]
+
+    @classmethod
+    def from_pages(cls, pages: Iterable[dict]) -> "BM25Index":
+        """
+        Build the index from the page records of the spider, with the same chunks as the
+        points of the Qdrant collection.
+        """
+        chunks = [
+            {"id": chunk.get("id"), "url": page["url"], "text": chunk["chunk_text"]}
+            for page in pages
+            for chunk in (page.get("chunked_text") or {}).get("embeddings", [])
+        ]
+        return cls(chunks)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, "r") as f:
+            return cls(json.load(f)["chunks"])
+
+    def save(self, path: str):
+        # Only the chunks are saved, the postings are rebuilt in a fraction of the load time
+        with open(path, "w") as f:
+            json.dump({"chunks": self.chunks}, f)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def search(self, query: str, limit: int) -> List[dict]:
+        """
+        :param query: The search query.
+        :param limit: Maximum number of results.
+        :return: The best chunks as search results, with their BM25 score in lexical_score.
+        """
+        scores: Dict[int, float] = defaultdict(float)
+        count = len(self.chunks)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, frequency in postings:
+                scores[i] += (
+                    idf * frequency * (self.k1 + 1) / (frequency + self.norms[i])
+                )
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [
+            {
+                "id": self.chunks[i]["id"],
+                "text": self.chunks[i]["text"],
+                "score": None,
+                "lexical_score": score,
+                "embeddings": None,
+                "url": self.chunks[i]["url"],
+            }
+            for i, score in best
+        ]
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[dict]], limit: int, k: int = 60
+) -> List[dict]:
+    """
+    Merge several rankings of search results: a result scores 1 / (k + rank) in each ranking
+    it appears in. Only the ranks are used, so dense similarities and BM25 scores don't
+    have to be comparable.
+
+    :param rankings: The results of each search, best first.
+    :param limit: Maximum number of results.
+    :param k: Damping of the top ranks.
+    :return: The best results, with their fused score normalized to [0, 1] in rrf_score.
+        The dense similarity stays in score, None for the results found by BM25 only.
+    """
+    fused: Dict[str, dict] = {}
+    for ranking in rankings:
+        for rank, result in enumerate(ranking, start=1):
+            key = result["id"] or result["text"]
+            if key in fused:
+                merged = fused[key]
+                for field, value in result.items():
+                    if merged.get(field) is None:
+                        merged[field] = value
+            else:
+                merged = fused[key] = {**result, "rrf_score": 0.0}
+            merged["rrf_score"] += 1 / (k + rank)
+    # Best possible score: first in every ranking
+    best_score = len(rankings) / (k + 1)
+    results = sorted(fused.values(), key=lambda r: r["rrf_score"], reverse=True)[:limit]
+    for result in results:
+        result["rrf_score"] /= best_score
+    logger.debug(
+        f"Fused {sum(len(ranking) for ranking in rankings)} results into {len(results)}"
+    )
+    return results
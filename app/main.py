@@ -1,17 +1,42 @@
 import os
 import sys
 import json
+import hmac
+import math
+import time
+import asyncio
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, StreamingResponse
-from fastapi_simple_rate_limiter import rate_limiter
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
-from models import QuestionOnUrlRequest
-from typing import Dict, Optional
+from models import QuestionOnUrlRequest, SubmitDomainRequest
+from typing import Dict, List, Optional, Set
 from urllib.parse import urlparse
 from models import MainExecute
+from sessions import get_conversation_store
+from jobs import IndexingJob, JobScheduler
+from domain_state import get_domain_state_store
+from domains import DomainRegistry
+from clients import close_clients
+from cache import get_embedding_cache
+from chat_logs import get_chat_log
+from streaming import (
+    cancel_on_disconnect,
+    prefetch,
+    request_sources,
+    sse_events,
+    stream_stats,
+)
+from admission import Overloaded, RateLimiter, StreamLimiter
+from metrics import (
+    REJECTED_REQUESTS,
+    observe_stage,
+    render,
+    request_timings,
+    server_timing,
+)
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
@@ -30,77 +55,220 @@ ORIGINS = os.getenv("ORIGINS", ["*"])
 if isinstance(ORIGINS, str):
     ORIGINS = eval(ORIGINS)
 SERVER_URL = os.getenv("SERVER_URL", "http://localhost:8080")
+SESSION_EVICTION_INTERVAL = float(os.getenv("SESSION_EVICTION_INTERVAL", 60))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 86400))
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+DOMAIN_STATUS_POLL_INTERVAL = float(os.getenv("DOMAIN_STATUS_POLL_INTERVAL", 1))
+MAX_LOADED_DOMAINS = int(os.getenv("MAX_LOADED_DOMAINS", 32))
+DOMAIN_IDLE_TTL = float(os.getenv("DOMAIN_IDLE_TTL", 3600))
+DOMAIN_MAX_MEMORY_MB = (
+    float(os.getenv("DOMAIN_MAX_MEMORY_MB"))
+    if os.getenv("DOMAIN_MAX_MEMORY_MB")
+    else None
+)
+
+# Seconds between two checks that the visitor is still connected during an answer
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.25))
+# Server-sent events: the token deltas are merged up to this size or this delay
+SSE_COALESCE_CHARS = int(os.getenv("SSE_COALESCE_CHARS", 64))
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", 50))
+
+# Questions per second and burst allowed per client
+QUESTION_RATE_LIMIT = float(os.getenv("QUESTION_RATE_LIMIT", 0.4))
+QUESTION_BURST = float(os.getenv("QUESTION_BURST", 2))
+# Answers generated at once, questions waiting for one of them and for how long
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", 32))
+MAX_WAITING_STREAMS = int(os.getenv("MAX_WAITING_STREAMS", 64))
+STREAM_QUEUE_TIMEOUT = float(os.getenv("STREAM_QUEUE_TIMEOUT", 5))
 
 host, port = urlparse(SERVER_URL).netloc.split(":")
 
 
-# Dictionary to store the status of each domain
+# Status of each domain, a snapshot of the domain state store shared by the workers
 domain_status: Dict[str, str] = {}
+domain_status_version = 0
+# Domains with a completed index, served even while they are indexed again
+indexed_domains: Set[str] = set()
+
+# MainExecute instances of the domains, built on their first question
+domain_instances = DomainRegistry(
+    factory=lambda domain: MainExecute(domain, load=False),
+    max_domains=MAX_LOADED_DOMAINS,
+    ttl=DOMAIN_IDLE_TTL,
+    max_memory_mb=DOMAIN_MAX_MEMORY_MB,
+)
 
-# Dictionary to store MainExecute instances for each domain
-domain_instances: Dict[str, MainExecute] = {}
+# Admission control of the questions
+question_rate_limiter = RateLimiter(rate=QUESTION_RATE_LIMIT, burst=QUESTION_BURST)
+stream_limiter = StreamLimiter(
+    max_streams=MAX_STREAMS,
+    max_waiting=MAX_WAITING_STREAMS,
+    max_wait=STREAM_QUEUE_TIMEOUT,
+)
 
+# Runs the crawl and indexing jobs in the background
+job_scheduler: Optional[JobScheduler] = None
+
+
+def load_domain_status() -> List[str]:
+    """
+    Import domain_status.json, or the domains of the data folder, into an empty state store,
+    and release the domains left queued or processing by a stopped worker.
+
+    :return: The released domains, to be queued again.
+    """
+    store = get_domain_state_store()
+    if store.version() == 0:
+        if os.path.exists(DOMAIN_STATUS_FILE):
+            with open(DOMAIN_STATUS_FILE, "r") as f:
+                store.import_statuses(json.load(f))
+        elif os.path.exists(DATA_FOLDER):
+            store.import_statuses(
+                {
+                    filename[:-5]: "completed"  # Remove the .json extension
+                    for filename in os.listdir(DATA_FOLDER)
+                    if filename.endswith(".json")
+                    # Not the sidecar indexes of the search
+                    and not filename.endswith((".lexical.json", ".vectors.json"))
+                }
+            )
+    recovered = store.recover()
+    if recovered:
+        logger.info(f"Released {len(recovered)} interrupted domains: {recovered}")
+    refresh_domain_status()
+    return recovered
+
+
+def refresh_domain_status() -> Dict[str, str]:
+    """
+    Apply the status changes made by all the workers to the domain_status of this worker.
+    A domain indexed again is reloaded on its next question, until then the questions are
+    answered with its previous index.
+    """
+    global domain_status_version
+    domain_status_version, changes = get_domain_state_store().changes(
+        domain_status_version
+    )
+    for domain, (status, indexed) in changes.items():
+        if status == "completed" and domain_status.get(domain) is not None:
+            domain_instances.invalidate(domain)
+        domain_status[domain] = status
+        if indexed:
+            indexed_domains.add(domain)
+        else:
+            indexed_domains.discard(domain)
+    return domain_status
 
-def load_domain_status():
-    if os.path.exists(DOMAIN_STATUS_FILE):
-        with open(DOMAIN_STATUS_FILE, "r") as f:
-            return json.load(f)
-    else:
-        return create_json_file()
 
+def set_domain_status(domain: str, status: str, error: Optional[str] = None) -> bool:
+    changed = get_domain_state_store().transition(domain, status, error)
+    refresh_domain_status()
+    return changed
 
-def create_json_file():
-    if os.path.exists(DATA_FOLDER):
-        for filename in os.listdir(DATA_FOLDER):
-            if filename.endswith(".json"):
-                domain = filename[:-5]  # Remove the .json extension
-                domain_status[domain] = "completed"
-    save_domain_status()
-    return domain_status
 
+def initialize_domains() -> List[str]:
+    """
+    Load the status of the domains. Their MainExecute are built on their first question,
+    so the startup time doesn't depend on the number of domains.
 
-def save_domain_status():
-    with open(DOMAIN_STATUS_FILE, "w") as f:
-        json.dump(domain_status, f)
+    :return: The domains whose indexing was interrupted, see load_domain_status.
+    """
+    recovered = load_domain_status()
+    print(f"Loaded domain status: {domain_status}")
+    return recovered
 
 
-def initialize_domains():
-    global domain_status, domain_instances
-    domain_status = load_domain_status()
-    print(f"Loaded domain status: {domain_status}")
-    for domain, status in domain_status.items():
-        print(f"Initializing domain: {domain}")
-        if status == "completed":
-            try:
-                main_execute = MainExecute(domain, load=False)
-                domain_instances[domain] = main_execute
-            except Exception as e:
-                logger.error(f"Failed to initialize domain {domain}: {str(e)}")
-                domain_status[domain] = f"failed: {str(e)}"
-                save_domain_status()
-
-
-def submit_url(url: Optional[str]):
+def submit_url(url: Optional[str]) -> IndexingJob:
     if url is None:
         raise HTTPException(status_code=400, detail="URL not set")
     domain = urlparse(url).netloc
-    if domain not in domain_status or domain_status[domain] not in [
-        "queued",
-        "processing",
-        "completed",
-    ]:
-        domain_status[domain] = "queued"
-        save_domain_status()
-        logger.info(f"Submitting domain: {domain}")
+    if not domain:
+        raise HTTPException(status_code=400, detail="Invalid URL")
+    job = job_scheduler.active_job(domain)
+    if job is not None:
+        logger.info(f"Domain {domain} already being processed")
+        return job
+    if not set_domain_status(domain, "queued"):
+        raise HTTPException(
+            status_code=409, detail=f"Domain {domain} already being processed"
+        )
+    job = job_scheduler.submit(domain)
+    logger.info(f"Submitting domain: {domain}")
+    return job
+
+
+async def on_job_change(job: IndexingJob):
+    """
+    Keep the domain state store in sync with the indexing jobs.
+    """
+    if job.status == "completed":
+        # The loaded retriever and caches are outdated, the next question rebuilds them
+        domain_instances.invalidate(job.domain)
+        set_domain_status(job.domain, "completed")
+        logger.info(f"{job.domain} indexation completed")
+    elif job.status == "failed":
+        logger.error(f"Failed to process domain {job.domain}: {job.error}")
+        set_domain_status(job.domain, "failed", job.error)
+    elif job.status == "cancelled":
+        # A domain indexed before keeps its previous index
+        set_domain_status(
+            job.domain, "completed" if job.domain in indexed_domains else "cancelled"
+        )
+    elif not set_domain_status(job.domain, "processing"):
+        logger.warning(
+            f"Unexpected status of {job.domain}: {domain_status.get(job.domain)}"
+        )
+
+
+def submit_urls(urls: List[str]):
+    for url in urls:
+        try:
+            submit_url(url)
+        except HTTPException as e:
+            logger.info(e.detail)
+
+
+async def watch_domain_status():
+    """
+    Poll the domain state store, so the domains indexed by the other workers are served
+    without a restart. The leases of the domains indexed by this worker are renewed, and
+    the domains of the workers that stopped renewing theirs are queued again.
+    """
+    store = get_domain_state_store()
+    last_heartbeat = time.monotonic()
+    while True:
+        await asyncio.sleep(DOMAIN_STATUS_POLL_INTERVAL)
         try:
-            process_domain(domain)
-            logger.info(f"{domain} indexation completed")
+            refresh_domain_status()
+            if (
+                job_scheduler is not None
+                and time.monotonic() - last_heartbeat >= store.lease_ttl / 3
+            ):
+                last_heartbeat = time.monotonic()
+                store.heartbeat()
+                recovered = store.recover()
+                if recovered:
+                    logger.info(f"Released {len(recovered)} stale domains: {recovered}")
+                    refresh_domain_status()
+                    submit_urls([f"https://{domain}" for domain in recovered])
         except Exception as e:
-            logger.error(f"Failed to process domain {domain}: {str(e)}")
-            domain_status[domain] = f"failed: {str(e)}"
-            save_domain_status()
-    else:
-        logger.info(f"Domain {domain} already being processed")
+            logger.error(f"Failed to refresh the domain status: {str(e)}")
+
+
+async def evict_idle_sessions():
+    """
+    Periodically drop the conversations of idle visitors and the idle domains so memory stays bounded.
+    """
+    conversation_store = get_conversation_store()
+    while True:
+        await asyncio.sleep(SESSION_EVICTION_INTERVAL)
+        evicted = conversation_store.evict_idle()
+        if evicted:
+            logger.info(f"Evicted {evicted} idle sessions")
+        evicted = domain_instances.evict_idle()
+        if evicted:
+            logger.info(f"Evicted {evicted} idle domains")
 
 
 @asynccontextmanager
@@ -108,7 +276,7 @@ async def lifespan(app: FastAPI):
     # Startup: You can add initialization code here
     logger.info("Starting the application")
 
-    initialize_domains()
+    interrupted = initialize_domains()
 
     logger.info(f"domains: {domain_status.keys()}")
 
@@ -116,8 +284,33 @@ async def lifespan(app: FastAPI):
 
     logger.info(f"Server URL: {SERVER_URL}")
 
+    eviction_task = asyncio.create_task(evict_idle_sessions())
+    watch_task = asyncio.create_task(watch_domain_status())
+    chat_log_task = asyncio.create_task(get_chat_log().run())
+
+    global job_scheduler
+    job_scheduler = JobScheduler(
+        max_workers=JOB_WORKERS,
+        depth=2,
+        on_change=on_job_change,
+        retention=JOB_RETENTION,
+    )
+    job_scheduler.start()
+    # Jobs interrupted by a restart are queued again, and URL if it was never indexed
+    urls = [f"https://{domain}" for domain in interrupted]
+    if urlparse(URL).netloc not in indexed_domains | set(interrupted):
+        urls.append(URL)
+    submit_urls(urls)
+
     yield  # Here the FastAPI application runs
 
+    eviction_task.cancel()
+    watch_task.cancel()
+    chat_log_task.cancel()
+    await job_scheduler.stop()
+    await get_chat_log().close()
+    await close_clients()
+
     # Shutdown: You can add cleanup code here if needed
     print("Shutting down the application")
 
@@ -136,13 +329,11 @@ app.add_middleware(
 )
 
 
-@rate_limiter(limit=3, seconds=60)
 @app.get("/")
 async def health_check():
     return {"status": "ok"}
 
 
-@rate_limiter(limit=3, seconds=60)
 # Serve static files
 @app.get("/static/chat-bubble.js")
 async def serve_component_file():
@@ -152,51 +343,184 @@ async def serve_component_file():
     return {"error": "File not found"}, 404
 
 
-def process_domain(domain: str):
-    domain_folder = os.path.join("data", domain)
-    os.makedirs(domain_folder, exist_ok=True)
-    logger.info(f"Indexing domain: {domain}")
-    try:
-        domain_status[domain] = "processing"
-        save_domain_status()
-        main_execute = MainExecute(domain)
-        domain_instances[domain] = main_execute
-        domain_status[domain] = "completed"
-        save_domain_status()
-    except Exception as e:
-        domain_status[domain] = f"failed: {str(e)}"
-        save_domain_status()
-
-
-@rate_limiter(limit=2, seconds=5)
-@app.post("/question_on_url")
-async def question_on_url(request: QuestionOnUrlRequest):
+@app.get("/cache_stats")
+async def cache_stats():
+    return {
+        "domains": domain_instances.stats(),
+        # Shared by all the domains
+        "embeddings": get_embedding_cache().stats(),
+        **{
+            domain: {
+                **main_execute.embeddings.cache_stats(),
+                "answers": main_execute.answer_cache.stats()
+                if main_execute.answer_cache
+                else None,
+            }
+            for domain, main_execute in domain_instances.items()
+        },
+    }
+
+
+@app.get("/stream_stats")
+async def get_stream_stats():
+    return stream_stats.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    # Prometheus text format
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
+def check_api_key(api_key: Optional[str]):
+    """
+    Guard the admin endpoints, which start crawls at our expense: they are disabled until
+    ADMIN_API_KEY is set.
+    """
+    if not ADMIN_API_KEY:
+        raise HTTPException(status_code=503, detail="ADMIN_API_KEY not set")
+    if not api_key or not hmac.compare_digest(api_key, ADMIN_API_KEY):
+        raise HTTPException(status_code=401, detail="Invalid API key")
+
+
+@app.get("/domains")
+async def list_domains(x_api_key: Optional[str] = Header(None)):
+    check_api_key(x_api_key)
+    store = get_domain_state_store()
+    errors = store.errors()
+    indexed = store.indexed()
+    return {
+        domain: {
+            "status": status,
+            "error": errors.get(domain),
+            "indexed": domain in indexed,
+        }
+        for domain, status in store.all().items()
+    }
+
+
+@app.post("/jobs")
+async def submit_job(
+    request: SubmitDomainRequest, x_api_key: Optional[str] = Header(None)
+) -> IndexingJob:
+    check_api_key(x_api_key)
+    return submit_url(request.url)
+
+
+@app.get("/jobs")
+async def list_jobs(x_api_key: Optional[str] = Header(None)) -> List[IndexingJob]:
+    check_api_key(x_api_key)
+    return list(job_scheduler.jobs.values())
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, x_api_key: Optional[str] = Header(None)) -> IndexingJob:
+    check_api_key(x_api_key)
+    job = job_scheduler.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(
+    job_id: str, x_api_key: Optional[str] = Header(None)
+) -> IndexingJob:
+    check_api_key(x_api_key)
+    job = await job_scheduler.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+def resolve_domain(request: QuestionOnUrlRequest, http_request: Request) -> str:
+    """
+    The domain a question is about: the url of the request, else the website embedding the
+    chat bubble (Origin header) if it is a known domain, else the default URL.
+    """
+    if request.url:
+        return urlparse(request.url).netloc or request.url
+    origin = urlparse(http_request.headers.get("origin") or "").netloc
+    if origin in domain_status:
+        return origin
     if URL is None:
         raise HTTPException(status_code=400, detail="URL not set")
-    url = URL
-    logger.debug(f"Question on URL: {url}")
-    question = request.question
-    domain = urlparse(url).netloc
+    return urlparse(URL).netloc
+
 
-    logger.debug(f"Domain: {domain}")
-    logger.debug(f"Domains: {domain_instances.keys()}")
+def check_rate_limit(http_request: Request):
+    """
+    Reject the client with a 429 if it asks questions faster than the rate limit. Behind a
+    proxy, set FORWARDED_ALLOW_IPS so the client is the X-Forwarded-For address.
+    """
+    client = http_request.client.host if http_request.client else "unknown"
+    retry_after = question_rate_limiter.acquire(client)
+    if retry_after:
+        REJECTED_REQUESTS.inc(reason="rate_limit")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many questions",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
 
-    if domain not in domain_instances:
-        raise HTTPException(status_code=400, detail="Domain not processed yet")
 
-    if domain_status.get(domain) != "completed":
+@app.post("/question_on_url")
+async def question_on_url(request: QuestionOnUrlRequest, http_request: Request):
+    check_rate_limit(http_request)
+    domain = resolve_domain(request, http_request)
+    logger.debug(f"Question on domain: {domain}")
+    question = request.question
+
+    # A domain being indexed again is answered with its previous index
+    if domain not in indexed_domains:
+        if domain not in domain_status:
+            raise HTTPException(status_code=400, detail="Domain not processed yet")
         raise HTTPException(status_code=400, detail="Domain processing not completed")
 
-    logger.debug(f"Domains: {domain_instances.keys()}")
-    main_execute = domain_instances[domain]
+    # Duration of the stages of this request, for the Server-Timing header
+    timings: Dict[str, float] = {}
+    request_timings.set(timings)
+    sources: List[dict] = []
+    request_sources.set(sources)
+    start_time = time.perf_counter()
+    main_execute = await domain_instances.get(domain)
+    observe_stage("domain", time.perf_counter() - start_time)
 
-    return StreamingResponse(main_execute.ask(question), media_type="text/plain")
+    # The headers are sent with the first token, once the searches are done
+    try:
+        chunks = await prefetch(
+            cancel_on_disconnect(
+                stream_limiter.limit(
+                    main_execute.ask(question, session_id=request.session_id)
+                ),
+                http_request.is_disconnected,
+                poll_interval=DISCONNECT_POLL_INTERVAL,
+            )
+        )
+    except Overloaded as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many questions at the moment",
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    headers = {"Server-Timing": server_timing(timings)}
+    # The chat bubble reads the plain text answer, other clients can ask for typed events
+    if "text/event-stream" in http_request.headers.get("accept", ""):
+        return StreamingResponse(
+            sse_events(
+                chunks,
+                sources,
+                timings,
+                max_chars=SSE_COALESCE_CHARS,
+                max_delay=SSE_COALESCE_MS / 1000,
+            ),
+            media_type="text/event-stream",
+            headers={**headers, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    return StreamingResponse(chunks, media_type="text/plain", headers=headers)
 
 
 if __name__ == "__main__":
-    initialize_domains()
-    submit_url(URL)
-
     import uvicorn
 
     uvicorn.run("main:app", host="0.0.0.0", port=int(port), reload=True)
@@ -0,0 +1,212 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        if not values and not self.labels:
+            values = [((), 0)]
+        for key, value in values:
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.value:g}",
+        ]
+
+
+class Histogram:
+    def __init__(
+        self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (count per bucket, +Inf last), sum
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(labels[label] for label in self.labels)
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[i] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = [
+                (key, list(counts), total[0])
+                for key, (counts, total) in self.values.items()
+            ]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                labels = format_labels(self.labels + ("le",), key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total:g}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return (
+        "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+    )
+
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Duration of the stages of the chat path: domain (loading the website), queue (waiting "
+    "for a stream slot), tool_call (first completion until its tool calls), embedding, "
+    "vector_search, retrieval, ttft, stream (first to last token) and answer.",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    labels=("stage",),
+)
+TOKENS_PER_SECOND = Histogram(
+    "chat_tokens_per_second",
+    "Streaming speed of the answers, in tokens per second after the first token.",
+    buckets=(5, 10, 20, 40, 60, 80, 120, 160, 240, 320),
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Lookups of the embedding, results and answer caches.",
+    labels=("cache", "result"),
+)
+ERRORS = Counter(
+    "errors_total", "Errors of the chat path, by stage.", labels=("stage",)
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total",
+    "Responses of an upstream API that trigger a retry (429 and 5xx).",
+    labels=("upstream",),
+)
+ANSWERS = Counter(
+    "answers_total", "Streamed answers, completed or cancelled.", labels=("status",)
+)
+TOKENS_SAVED = Counter(
+    "tokens_saved_total",
+    "Estimated tokens not generated because the visitor left during the answer.",
+)
+STREAMS_ACTIVE = Gauge("streams_active", "Answers being generated.")
+STREAMS_WAITING = Gauge("streams_waiting", "Questions waiting for a stream slot.")
+REJECTED_REQUESTS = Counter(
+    "rejected_requests_total",
+    "Questions rejected by the admission control: rate_limit (429), queue_full and "
+    "queue_timeout (503).",
+    labels=("reason",),
+)
+CHAT_LOGS = Counter(
+    "chat_logs_total",
+    "Logs of the answers: sent to the sink, dropped or spilled to disk when the queue is full.",
+    labels=("status",),
+)
+CHAT_LOG_QUEUE = Gauge("chat_log_queue", "Logs of the answers waiting to be sent.")
+METRICS = [
+    STAGE_SECONDS,
+    TOKENS_PER_SECOND,
+    CACHE_REQUESTS,
+    ERRORS,
+    UPSTREAM_RETRIES,
+    ANSWERS,
+    TOKENS_SAVED,
+    STREAMS_ACTIVE,
+    STREAMS_WAITING,
+    REJECTED_REQUESTS,
+    CHAT_LOGS,
+    CHAT_LOG_QUEUE,
+]
+
+# Stage durations of the current request, for its Server-Timing header
+request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = request_timings.get()
+    if timings is not None:
+        # A stage run several times in a request (searches of a tool round) adds up
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    Time a block as a stage of the chat path. Failed blocks are counted in errors_total
+    instead, and cancelled ones are ignored.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=stage)
+        raise
+    observe_stage(stage, time.perf_counter() - start_time)
+
+
+def cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """
+    :return: The Server-Timing header value of the stage durations, in milliseconds.
+    """
+    return ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+    )
+
+
+def render() -> str:
+    """
+    :return: All the metrics in the Prometheus text format.
+    """
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
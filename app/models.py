@@ -2,36 +2,65 @@ from loguru import logger
 from scraper import (
     TextContentSpider,
 )  # load the scraper from our scrapy project
+from scrapy import signals  # type:ignore
 from scrapy.crawler import CrawlerProcess  # type:ignore
 from scrapy.utils.project import (  # type:ignore
     get_project_settings,
 )
-from qdrant_client import QdrantClient
+from qdrant_client import models as qdrant_models
 from llama_index.vector_stores.qdrant import QdrantVectorStore
 from llama_index.core import StorageContext
-from llama_index.embeddings.mistralai import MistralAIEmbedding
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader
+from llama_index.core import VectorStoreIndex, QueryBundle
+from llama_index.core.schema import TextNode
+import re
+import math
 import time
 import json
-from mistralai import Mistral, AssistantMessage, ToolMessage
+import uuid
+from mistralai import AssistantMessage, FunctionCall, ToolCall, ToolMessage
 import os
+import asyncio
 import functools
-from typing import Generator
+import numpy as np
+from typing import AsyncGenerator, Callable
 from dotenv import load_dotenv
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from pydantic import BaseModel
-import phospho
+from sessions import get_conversation_store
+from chat_logs import get_chat_log
+from cache import (
+    SemanticAnswerCache,
+    TTLCache,
+    get_embedding_cache,
+    normalize_query,
+)
+from context import pack_context, text_tokens
+from streaming import add_sources
+from lexical import BM25Index, reciprocal_rank_fusion
+from vectors import LocalVectorIndex
+from metrics import ERRORS, TOKENS_PER_SECOND, cache_lookup, observe_stage, timed
+from clients import (
+    get_async_qdrant_client,
+    get_embed_model,
+    get_mistral_client,
+    get_qdrant_client,
+)
 
 load_dotenv()
 
-phospho.init()
-
 # Check that the environment variables are set
 assert os.getenv("MISTRAL_API_KEY"), "MISTRAL_API_KEY environment variable not set"
 
 
 class QuestionOnUrlRequest(BaseModel):
     question: str
+    session_id: Optional[str] = None
+    # The website the question is about, defaults to the one of the chat bubble
+    url: Optional[str] = None
+
+
+class SubmitDomainRequest(BaseModel):
+    url: str
 
 
 class ScraperInterface:
@@ -54,15 +83,38 @@ class ScraperInterface:
         self.output_path = os.path.join(os.getcwd(), "data", f"{domain}.json")
         self.spider_db = os.path.join(os.getcwd(), "data")
 
-    def run_crawler(self):
+    def run_crawler(self, progress: Optional[Callable[[dict], None]] = None):
         """
         Run the Scrapy crawler to scrape the website.
+
+        :param progress: Called with the crawl progress (pages crawled, chunks embedded,
+            pages pending and ETA in seconds) after every crawled page.
         """
         print("Running crawler")
         start_time = time.time()
         process = CrawlerProcess(get_project_settings())
+        crawler = process.create_crawler(TextContentSpider)
+        if progress is not None:
+
+            def on_response(response, request, spider):
+                stats = crawler.stats
+                pages = stats.get_value("response_received_count", 0) + 1
+                pending = stats.get_value("scheduler/enqueued", 0) - stats.get_value(
+                    "scheduler/dequeued", 0
+                )
+                rate = pages / max(time.time() - start_time, 1e-6)
+                progress(
+                    {
+                        "pages_crawled": pages,
+                        "pages_pending": pending,
+                        "chunks_embedded": stats.get_value("embedding/chunks", 0),
+                        "eta": pending / rate,
+                    }
+                )
+
+            crawler.signals.connect(on_response, signal=signals.response_received)
         process.crawl(
-            TextContentSpider,
+            crawler,
             domain=self.domain,
             depth=self.depth,
             output_path=self.output_path,
@@ -83,59 +135,241 @@ class EmbeddingsVS:
         """
         self.vector_db_name = domain.replace(".", "_")
         self.domain = domain
-        self.embed_model = MistralAIEmbedding(
-            model_name="mistral-embed", api_key=os.getenv("MISTRAL_API_KEY")
+        # The clients are shared by all the domains of the process
+        self.embed_model = get_embed_model()
+        self.client = get_qdrant_client()
+        # Async client used by the chat path so that retrieval doesn't block the event loop
+        self.aclient = get_async_qdrant_client()
+        self.scrapped_path = os.path.join(os.getcwd(), "data")
+        self.domain_path = os.path.join(self.scrapped_path, f"{domain}.json")
+        self.reuse_spider_embeddings = False
+        self.limit = 5
+        # Built once per domain by load_retriever, rebuilt only on re-indexing
+        self.retriever = None
+        # Query embeddings don't depend on the collection: their cache is shared by all
+        # the domains. Search results are keyed by index version
+        self.index_version = 0
+        self.embedding_cache = get_embedding_cache()
+        self.results_cache = TTLCache(
+            max_size=int(os.getenv("QUERY_CACHE_SIZE", 1024)),
+            ttl=float(os.getenv("QUERY_CACHE_TTL", 3600)),
         )
+        # BM25 index of the chunks, fused with the dense results, see lexical.py
+        self.lexical: Optional[BM25Index] = None
+        self.hybrid = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+        # Latency budget of the embedding call and the Qdrant search, the BM25 results
+        # are used alone when it is exceeded or when they fail
+        self.dense_timeout = float(os.getenv("DENSE_SEARCH_TIMEOUT", 2))
+        # Latency budget of the BM25 search, the dense results are used alone past it
+        self.lexical_timeout = float(os.getenv("LEXICAL_SEARCH_TIMEOUT", 0.5))
+        # "qdrant", or "local" to search the vectors in-process, see vectors.py
+        self.backend = os.getenv("VECTOR_BACKEND", "qdrant")
+        self.vectors: Optional[LocalVectorIndex] = None
+        self.max_float32_mb = float(os.getenv("LOCAL_VECTORS_FLOAT32_MB", 0))
 
-        if os.getenv("QDRANT_API_KEY") and os.getenv("QDRANT_LOCATION"):
-            logger.info("Connecting to Qdrant cloud")
-            try:
-                self.client = QdrantClient(
-                    api_key=os.getenv("QDRANT_API_KEY"),
-                    location=os.getenv("QDRANT_LOCATION"),
-                )
-            except Exception as e:
-                logger.error(f"Failed to connect to Qdrant: {str(e)}")
-                self.client = None
-                logger.error(f"QDRANT_API_KEY: {os.getenv('QDRANT_API_KEY')}")
-                logger.error(f"QDRANT_LOCATION: {os.getenv('QDRANT_LOCATION')}")
-        else:
-            logger.info("Connecting to Qdrant local")
-            self.client = QdrantClient(
-                # you can use :memory: mode for fast and light-weight experiments,
-                # it does not require to have Qdrant deployed anywhere
-                # but requires qdrant-client >= 1.1.1
-                # location=":memory:"
-                # otherwise set Qdrant instance address with:
-                # url="http://<host>:<port>"
-                # otherwise set Qdrant instance with host and port:
-                host="qdrant",
-                port=6333,
-                # set API KEY for Qdrant Cloud
-                # api_key=QDRANT_API_KEY,
+    @property
+    def lexical_path(self) -> str:
+        return os.path.splitext(self.domain_path)[0] + ".lexical.json"
+
+    @property
+    def vectors_path(self) -> str:
+        return os.path.splitext(self.domain_path)[0]
+
+    def load_pages(self) -> List[dict]:
+        """
+        Load the pages crawled by the spider for this domain.
+        Only data/{domain}.json is read, the other domains of the data folder are never indexed here.
+
+        :return: The page records of data/{domain}.json.
+        """
+        with open(self.domain_path, "r") as f:
+            db_data = json.load(f)
+        # The chunk vectors of the spider can only be reused if they come from the same model
+        self.reuse_spider_embeddings = (
+            db_data.get("config", {}).get("embedding_model")
+            == self.embed_model.model_name
+        )
+        return db_data["data"]
+
+    def indexed_pages(self) -> Dict[Optional[str], Optional[str]]:
+        """
+        Scroll the collection to find which pages are indexed and with which content hash.
+        Points uploaded before the incremental indexing have no url and are listed under None.
+
+        :return: A dictionary url -> content_hash of the indexed pages.
+        """
+        if not self.client.collection_exists(self.vector_db_name):
+            return {}
+        pages: Dict[Optional[str], Optional[str]] = {}
+        offset = None
+        while True:
+            points, offset = self.client.scroll(
+                collection_name=self.vector_db_name,
+                with_payload=["url", "content_hash"],
+                with_vectors=False,
+                limit=1000,
+                offset=offset,
             )
-        self.scrapped_path = os.path.join(os.getcwd(), "data")
-        self.limit = 5
+            for point in points:
+                pages[point.payload.get("url")] = point.payload.get("content_hash")
+            if offset is None:
+                return pages
+
+    def delete_pages(
+        self, urls: List[Optional[str]], keep: Optional[Dict[str, List[str]]] = None
+    ):
+        """
+        Delete the points of the given pages from the collection.
+
+        :param urls: The urls of the pages. None deletes the points without url.
+        :param keep: The ids of the points to keep by url, the chunks just uploaded.
+        """
+        if None in urls:
+            self.client.delete(
+                collection_name=self.vector_db_name,
+                points_selector=qdrant_models.Filter(
+                    must=[
+                        qdrant_models.IsEmptyCondition(
+                            is_empty=qdrant_models.PayloadField(key="url")
+                        )
+                    ]
+                ),
+            )
+        urls = [url for url in urls if url is not None]
+        keep = keep or {}
+        for i in range(0, len(urls), 100):
+            keep_ids = [id_ for url in urls[i : i + 100] for id_ in keep.get(url, [])]
+            self.client.delete(
+                collection_name=self.vector_db_name,
+                points_selector=qdrant_models.Filter(
+                    must=[
+                        qdrant_models.FieldCondition(
+                            key="url",
+                            match=qdrant_models.MatchAny(any=urls[i : i + 100]),
+                        )
+                    ],
+                    must_not=[qdrant_models.HasIdCondition(has_id=keep_ids)]
+                    if keep_ids
+                    else None,
+                ),
+            )
+
+    def page_nodes(self, page: dict) -> List[TextNode]:
+        """
+        Build the nodes of the chunks of a page.
+        The id of a node is derived from the url and the chunk index, so re-indexing a page
+        overwrites its points instead of duplicating them.
+
+        :param page: A page record of the spider.
+        :return: The nodes of the page, with the embeddings computed by the spider if they can be reused.
+        """
+        chunks = (page.get("chunked_text") or {}).get("embeddings", [])
+        return [
+            TextNode(
+                id_=str(uuid.uuid5(uuid.NAMESPACE_URL, f"{page['url']}#{i}")),
+                text=chunk["chunk_text"],
+                embedding=chunk.get("embedding")
+                if self.reuse_spider_embeddings
+                else None,
+                metadata={
+                    "url": page["url"],
+                    "content_hash": page["content_hash"],
+                    "id": chunk.get("id"),
+                },
+            )
+            for i, chunk in enumerate(chunks)
+        ]
+
+    def changed_pages(
+        self, pages: Dict[str, dict], indexed: Dict[Optional[str], Optional[str]]
+    ) -> Tuple[List[str], List[Optional[str]]]:
+        """
+        :param pages: The page records of the spider by url.
+        :param indexed: The content hash of the indexed pages by url.
+        :return: The urls of the pages added or changed, and of the pages removed.
+        """
+        changed = [
+            url
+            for url, page in pages.items()
+            if indexed.get(url) != page["content_hash"]
+        ]
+        removed = [url for url in indexed if url not in pages]
+        return changed, removed
+
+    def embed_nodes(self, nodes: List[TextNode]):
+        """
+        Compute the embeddings of the nodes. Only the chunks without a spider embedding
+        are sent to the embedding API.
+        """
+        to_embed = [node for node in nodes if node.embedding is None]
+        if to_embed:
+            embeddings = self.embed_model.get_text_embedding_batch(
+                [node.text for node in to_embed]
+            )
+            for node, embedding in zip(to_embed, embeddings):
+                node.embedding = embedding
+        reused = len(nodes) - len(to_embed)
+        logger.info(
+            f"Reused {reused} spider embeddings, saved "
+            f"{math.ceil(reused / self.embed_model.embed_batch_size)} embedding API calls"
+        )
 
     def upload_embeddings(self):
         """
-        Upload the embeddings to the Qdrant vector database.
+        Upload the embeddings to the Qdrant vector database, or to the local vector index.
+        The collection is synchronized incrementally with the content_hash computed by the spider:
+        only the pages that were added, changed or removed since the last upload are embedded or deleted.
         """
         try:
-            documents = SimpleDirectoryReader(self.scrapped_path).load_data()
+            pages = {page["url"]: page for page in self.load_pages()}
+
+            # The BM25 index is local and cheap to build, it is rebuilt from all the pages
+            self.lexical = BM25Index.from_pages(pages.values())
+            self.lexical.save(self.lexical_path)
+
+            if self.backend == "local":
+                return self.upload_local(pages)
+
+            indexed = self.indexed_pages()
+            changed, removed = self.changed_pages(pages, indexed)
 
             vector_store = QdrantVectorStore(
-                client=self.client, collection_name=self.vector_db_name
+                client=self.client,
+                aclient=self.aclient,
+                collection_name=self.vector_db_name,
             )
-            storage_context = StorageContext.from_defaults(vector_store=vector_store)
-            index = VectorStoreIndex.from_documents(
-                documents,
-                storage_context=storage_context,
-                embed_model=self.embed_model,
+            nodes = [node for url in changed for node in self.page_nodes(pages[url])]
+            self.embed_nodes(nodes)
+            if nodes:
+                # The ids are deterministic: the chunks of a changed page overwrite its points
+                vector_store.add(nodes)
+                self.client.create_payload_index(
+                    collection_name=self.vector_db_name,
+                    field_name="url",
+                    field_schema=qdrant_models.PayloadSchemaType.KEYWORD,
+                )
+            # Then delete the points left over, so a failed embedding never leaves a page
+            # without chunks: those of the removed pages, and those past the last chunk of a
+            # changed page that got shorter
+            keep: Dict[str, List[str]] = {}
+            for node in nodes:
+                keep.setdefault(node.metadata["url"], []).append(node.node_id)
+            self.delete_pages(
+                [url for url in changed if url in indexed] + removed, keep
             )
             logger.info(
-                f"Uploaded {len(documents)} documents to {self.vector_db_name} collection"
+                f"Indexed {self.vector_db_name} collection: {len(changed)} pages added or changed "
+                f"({len(nodes)} chunks), {len(removed)} removed, {len(pages) - len(changed)} unchanged"
+            )
+
+            index = VectorStoreIndex.from_vector_store(
+                vector_store, embed_model=self.embed_model
             )
+            self.retriever = index.as_retriever(similarity_top_k=self.limit)
+            if changed or removed:
+                # The collection changed: cached results are stale
+                self.index_version += 1
+                self.results_cache.clear()
 
             return index
         except Exception as e:
@@ -143,17 +377,70 @@ class EmbeddingsVS:
 
             raise e
 
-    def search(self, query: str) -> List[dict]:
+    def upload_local(self, pages: Dict[str, dict]) -> LocalVectorIndex:
         """
-        Search the vector database for the given query.
+        Synchronize the local vector index with the pages, like the Qdrant collection.
 
-        :param query: The search query.
-        :return: A dictionary of search results.
+        :param pages: The page records of the spider by url.
+        :return: The updated index, saved next to the pages of the spider.
+        """
+        vectors = self.vectors
+        if vectors is None:
+            vectors = LocalVectorIndex.load(self.vectors_path, self.max_float32_mb)
+        if vectors is None:
+            vectors = LocalVectorIndex.build([], [], self.max_float32_mb)
+        changed, removed = self.changed_pages(pages, vectors.pages())
+
+        nodes = [node for url in changed for node in self.page_nodes(pages[url])]
+        self.embed_nodes(nodes)
+        chunks = [
+            {
+                "id": node.metadata["id"],
+                "url": node.metadata["url"],
+                "content_hash": node.metadata["content_hash"],
+                "text": node.text,
+            }
+            for node in nodes
+        ]
+        if changed or removed or not os.path.exists(f"{self.vectors_path}.vectors.npy"):
+            vectors = vectors.update(
+                set(changed + removed),
+                chunks,
+                [node.embedding for node in nodes],
+                self.max_float32_mb,
+            )
+            vectors.save(self.vectors_path)
+        logger.info(
+            f"Indexed {self.domain} locally: {len(changed)} pages added or changed "
+            f"({len(nodes)} chunks), {len(removed)} removed, {len(pages) - len(changed)} unchanged"
+        )
+
+        self.vectors = vectors
+        if changed or removed:
+            self.index_version += 1
+            self.results_cache.clear()
+        return vectors
+
+    def load_retriever(self):
         """
+        Build the retriever of the domain and keep it for all the next searches.
+        It is only rebuilt when the collection is re-indexed with upload_embeddings.
+
+        :return: The retriever of the domain, or the local vector index.
+        """
+        if self.backend == "local":
+            self.vectors = LocalVectorIndex.load(self.vectors_path, self.max_float32_mb)
+            if self.vectors is None:
+                logger.info(f"No local vectors for {self.domain}. Creating new index.")
+                self.upload_embeddings()
+            else:
+                self.load_lexical()
+            return self.vectors
         try:
             # Try to load existing index
             vector_store = QdrantVectorStore(
                 client=self.client,
+                aclient=self.aclient,
                 collection_name=self.vector_db_name,
             )
             storage_context = StorageContext.from_defaults(vector_store=vector_store)
@@ -162,16 +449,161 @@ class EmbeddingsVS:
                 storage_context=storage_context,
                 embed_model=self.embed_model,
             )
+            self.retriever = index.as_retriever(similarity_top_k=self.limit)
+            self.load_lexical()
         except Exception as _:
             logger.info(
                 f"Collection {self.vector_db_name} not found. Creating new index."
             )
-            index = self.upload_embeddings()
+            self.upload_embeddings()
+
+        return self.retriever
+
+    def load_lexical(self) -> Optional[BM25Index]:
+        """
+        Load the BM25 index saved by upload_embeddings. Domains indexed before it existed get
+        their index built from the pages of the spider.
+
+        :return: The BM25 index, or None if the domain has no pages.
+        """
+        try:
+            if os.path.exists(self.lexical_path):
+                self.lexical = BM25Index.load(self.lexical_path)
+            elif os.path.exists(self.domain_path):
+                self.lexical = BM25Index.from_pages(self.load_pages())
+                self.lexical.save(self.lexical_path)
+        except Exception as e:
+            logger.error(f"Failed to load the lexical index of {self.domain}: {str(e)}")
+            self.lexical = None
+        return self.lexical
+
+    async def aembed_query(self, query: str) -> np.ndarray:
+        """
+        Embed a query without blocking the event loop, reusing the cached embedding if any.
+        """
+        key = normalize_query(query)
+        embedding = self.embedding_cache.get(key)
+        cache_lookup("embeddings", embedding is not None)
+        if embedding is None:
+            with timed("embedding"):
+                embedding = await self.embed_model.aget_query_embedding(query)
+            embedding = np.asarray(embedding, dtype=np.float32)
+            self.embedding_cache.set(key, embedding)
+        return embedding
+
+    async def asearch(
+        self, query: str, failed_searches: Optional[List[str]] = None
+    ) -> List[dict]:
+        """
+        Search the vector database for the given query without blocking the event loop.
+        The query embedding and the Qdrant search both go through async clients, and the
+        BM25 search of HYBRID_SEARCH runs in a thread at the same time.
+        If the dense search fails or takes more than DENSE_SEARCH_TIMEOUT, the BM25 results
+        are returned alone.
+
+        :param query: The search query.
+        :param failed_searches: The query is appended to this list if the BM25 results are
+            returned alone.
+        :return: A dictionary of search results.
+        """
+        key = (self.index_version, normalize_query(query))
+        results = self.results_cache.get(key)
+        cache_lookup("results", results is not None)
+        if results is not None:
+            return results
+        lexical_task = (
+            asyncio.ensure_future(self.lexical_search(query))
+            if self.hybrid and self.lexical is not None
+            else None
+        )
+        try:
+            with timed("retrieval"):
+                try:
+                    results = await asyncio.wait_for(
+                        self.dense_search(query), timeout=self.dense_timeout
+                    )
+                except Exception as e:
+                    ERRORS.inc(stage="dense_search")
+                    lexical = (
+                        await lexical_task
+                        if lexical_task is not None
+                        else await self.lexical_search(query)
+                    )
+                    if lexical is None:
+                        raise
+                    logger.warning(
+                        f"Dense search failed ({e!r}), using the lexical index of {self.domain}"
+                    )
+                    if failed_searches is not None:
+                        failed_searches.append(query)
+                    # Not cached: the next query tries the dense search again
+                    return reciprocal_rank_fusion([lexical], self.limit)
+                if lexical_task is None:
+                    self.results_cache.set(key, results)
+                    return results
+                lexical = await lexical_task
+        finally:
+            if lexical_task is not None and not lexical_task.done():
+                lexical_task.cancel()
+        if lexical is None:
+            # Not cached: the next query tries the BM25 search again
+            return results
+        results = reciprocal_rank_fusion([results, lexical], self.limit)
+        self.results_cache.set(key, results)
+        return results
+
+    async def lexical_search(self, query: str) -> Optional[List[dict]]:
+        """
+        Search the BM25 index in a thread: it is pure Python, and would block the event
+        loop, so every other answer, for tens of milliseconds on large websites.
+
+        :return: The BM25 results, or None if there is no index, or if the search failed
+            or took more than LEXICAL_SEARCH_TIMEOUT.
+        """
+        if self.lexical is None:
+            return None
+        try:
+            with timed("lexical_search"):
+                return await asyncio.wait_for(
+                    asyncio.to_thread(self.lexical.search, query, self.limit),
+                    timeout=self.lexical_timeout,
+                )
+        except Exception as e:
+            ERRORS.inc(stage="lexical_search")
+            logger.warning(f"Lexical search of {self.domain} failed: {e!r}")
+            return None
+
+    async def dense_search(self, query: str) -> List[dict]:
+        embedding = await self.aembed_query(query)
+        with timed("vector_search"):
+            if self.backend == "local":
+                vectors = (
+                    self.vectors if self.vectors is not None else self.load_retriever()
+                )
+                # NumPy releases the GIL during the product
+                return await asyncio.to_thread(vectors.search, embedding, self.limit)
+            retriever = self.retriever or self.load_retriever()
+            nodes = await retriever.aretrieve(
+                QueryBundle(query, embedding=embedding.tolist())
+            )
+        return self.to_results(nodes)
 
-        # Perform the search
-        retriever = index.as_retriever(similarity_top_k=self.limit)
-        results = retriever.retrieve(query)
+    def cache_stats(self) -> dict:
+        """
+        Hit and miss counters of the search results cache of the domain.
+        """
+        return {
+            "index_version": self.index_version,
+            "results": self.results_cache.stats(),
+        }
 
+    def to_results(self, results) -> List[dict]:
+        """
+        Convert the nodes returned by the retriever to search results.
+
+        :param results: The nodes returned by the retriever.
+        :return: A dictionary of search results.
+        """
         results_embeddings = [
             {
                 "id": node.metadata.get("id"),
@@ -188,26 +620,39 @@ class EmbeddingsVS:
 
 
 class ChatMistral:
-    def __init__(self, domain):
+    def __init__(self, domain, embeddings: Optional[EmbeddingsVS] = None):
         """
         Initialize the ChatMistral with domain.
 
         :param domain: The domain to chat about.
+        :param embeddings: The EmbeddingsVS of the domain, shared with MainExecute so that
+            re-indexing refreshes the retriever used by the chat.
         """
         self.domain = domain
-        self.embeddings = EmbeddingsVS(domain)
-        self.client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
+        self.embeddings = embeddings or EmbeddingsVS(domain)
+        self.client = get_mistral_client()
         self.model = "mistral-large-latest"
         self.temperature = 0.7
+        self.conversations = get_conversation_store()
+        # How the context is retrieved, see chat
+        self.mode = os.getenv("CHAT_MODE", "tool")
+        # Minimum similarity of the best search result to skip the tool call in the retrieval modes
+        self.min_score = float(os.getenv("RETRIEVAL_MIN_SCORE", 0.75))
+        # Maximum number of turns of searches before the model has to answer
+        self.max_tool_rounds = max(int(os.getenv("MAX_TOOL_ROUNDS", 1)), 1)
+        # Packing of the search results sent to the model, see context.pack_context
+        self.context_max_tokens = int(os.getenv("CONTEXT_MAX_TOKENS", 1500))
+        self.context_dedup_threshold = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", 0.8))
+        self.context_mmr_lambda = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7))
         self.names_to_functions = {
-            "search_context": functools.partial(self.embeddings.search),
+            "search_context": functools.partial(self.embeddings.asearch),
         }
         self.tools = [
             {
                 "type": "function",
                 "function": {
                     "name": "search_context",
-                    "description": f"Use this tool to get more context about what you don't know. This tool allows you to have access to all the data of the website {self.domain}",
+                    "description": f"Use this tool to get more context about what you don't know. This tool allows you to have access to all the data of the website {self.domain}. Call it several times at once to search for several topics.",
                     "parameters": {
                         "type": "object",
                         "properties": {
@@ -231,105 +676,331 @@ class ChatMistral:
         """
         return "\n".join([tool["text"] for tool in tools_output])
 
-    def search_context(self, query: str):
+    async def search_context(self, query: str):
         """
         Search the context for the given query.
 
         :param query: The search query.
         :return: The search results.
         """
-        results = self.embeddings.search(query)
+        results = await self.embeddings.asearch(query)
         return results
 
-    def chat(self, query: str) -> Generator[str, None, None]:
+    def context_is_good(self, results: List[dict]) -> bool:
         """
-        Chat with the Mistral model.
-        It uses the official Mistral chat documentation with modifications to handle streaming tool calls.
+        Whether the results of a search are relevant enough to answer without asking the model
+        for its own search query.
+        """
+        return (
+            bool(results)
+            and max(r.get("score") or 0 for r in results) >= self.min_score
+        )
 
-        :param query: The chat query.
-        :return: A generator yielding chat responses.
+    @staticmethod
+    def result_key(result: dict) -> str:
+        return result["id"] or result["text"]
+
+    def pack(self, results: List[dict]) -> List[dict]:
         """
-        system_message = "You are a helpful assistant. Be straightforward and helpful. Keep your answers short and to the point. You answer in the language spoken to you."
-        self.messages = [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": query},
+        Drop the near-duplicate chunks and fit the others in the token budget of the context.
+        """
+        packed, _ = pack_context(
+            results,
+            max_tokens=self.context_max_tokens,
+            dedup_threshold=self.context_dedup_threshold,
+            mmr_lambda=self.context_mmr_lambda,
+        )
+        return packed
+
+    def retrieval_messages(self, query: str, results: List[dict]) -> list:
+        """
+        The messages of a search_context(query) tool call and its results, as if the model had
+        asked for it, so the answer is generated from the same prompt as in the tool mode.
+        """
+        tool_call = ToolCall(
+            id=uuid.uuid4().hex[:9],
+            function=FunctionCall(
+                name="search_context", arguments=json.dumps({"query": query})
+            ),
+        )
+        packed = self.pack(results)
+        add_sources(packed)
+        return [
+            AssistantMessage(content="", tool_calls=[tool_call]),
+            ToolMessage(
+                name="search_context",
+                content=ChatMistral.tools_to_str(packed),
+                tool_call_id=tool_call.id,
+            ),
         ]
-        chat_response = self.client.chat.stream(
+
+    async def stream_completion(
+        self, messages: list, tool_calls: List[ToolCall], tool_choice: str = "auto"
+    ) -> AsyncGenerator[str, None]:
+        """
+        Stream a completion that can call the tools. The model may ask for several searches
+        in one turn.
+
+        :param tool_calls: The tool calls of the completion are appended to this list.
+        :param tool_choice: "any" to force at least one tool call, "auto" to let the model answer.
+        """
+        chat_response = await self.client.chat.stream_async(
             model=self.model,
-            messages=self.messages,
+            messages=messages,
             temperature=self.temperature,
             tools=self.tools,
-            tool_choice="any",
+            tool_choice=tool_choice,
         )
-        tool_call = False
-        tool_call_data = None
-        message_to_add = ""
+        async with chat_response:
+            async for data in chat_response:
+                chunk = data.data.choices[0]
+                if hasattr(chunk, "delta"):
+                    delta = chunk.delta
+                    if hasattr(delta, "tool_calls") and delta.tool_calls:
+                        tool_calls.extend(
+                            call
+                            for call in delta.tool_calls
+                            if call.id not in {known.id for known in tool_calls}
+                        )
+                    if hasattr(delta, "content") and delta.content:
+                        yield delta.content
+                elif hasattr(chunk, "content") and chunk.content:
+                    yield chunk.content
 
-        for data in chat_response:
-            chunk = data.data.choices[0]
-            if hasattr(chunk, "delta"):
-                delta = chunk.delta
-                if hasattr(delta, "tool_calls") and delta.tool_calls:
-                    tool_call = True
-                    if not tool_call_data:
-                        tool_call_data = delta.tool_calls[0]
-                        function_name = tool_call_data.function.name
-                        function_args = tool_call_data.function.arguments
-                if hasattr(delta, "content") and delta.content:
-                    message_to_add += delta.content
-                    yield delta.content
-            elif hasattr(chunk, "content") and chunk.content:
-                message_to_add += chunk.content
-                yield chunk.content
-
-            if tool_call:
-                break
+    async def first_completion(self, messages: list) -> Tuple[List[ToolCall], str]:
+        """
+        Ask the model for its search_context tool calls.
+
+        :return: The tool calls, and the content of the completion.
+        """
+        tool_calls: List[ToolCall] = []
+        content = ""
+        with timed("tool_call"):
+            async for chunk in self.stream_completion(
+                messages, tool_calls, tool_choice="any"
+            ):
+                content += chunk
+        return tool_calls, content
+
+    async def run_tools(
+        self,
+        tool_calls: List[ToolCall],
+        seen: set,
+        failed_searches: Optional[List[str]] = None,
+    ) -> List[ToolMessage]:
+        """
+        Run the tool calls of a turn concurrently. A chunk found by several searches is only
+        sent once to the model.
 
-        if tool_call:
-            print(f"tool call: {tool_call_data}")
-            print(
-                f"debug: appending message: {AssistantMessage(content=message_to_add, tool_calls=[tool_call_data])}"
+        :param seen: The ids of the chunks already sent, updated with the new ones.
+        :param failed_searches: The queries of the failed or degraded searches are appended
+            to this list, see EmbeddingsVS.asearch.
+        :return: One tool message per tool call.
+        """
+
+        async def run(tool_call: ToolCall) -> List[dict]:
+            function_args = tool_call.function.arguments
+            if isinstance(function_args, str):
+                function_args = json.loads(function_args)
+            return await self.names_to_functions[tool_call.function.name](
+                **function_args, failed_searches=failed_searches
             )
-            self.messages.append(
-                AssistantMessage(
-                    content=message_to_add,
-                    tool_calls=[tool_call_data],
+
+        outputs = await asyncio.gather(
+            *[run(tool_call) for tool_call in tool_calls], return_exceptions=True
+        )
+        # Pack the new chunks of all the searches of the turn together
+        candidates = {}
+        for output in outputs:
+            if not isinstance(output, Exception):
+                for r in output:
+                    if ChatMistral.result_key(r) not in seen:
+                        candidates.setdefault(ChatMistral.result_key(r), r)
+        packed = {
+            ChatMistral.result_key(r): r for r in self.pack(list(candidates.values()))
+        }
+        add_sources(list(packed.values()))
+        tool_messages = []
+        for tool_call, output in zip(tool_calls, outputs):
+            if isinstance(output, Exception):
+                logger.error(f"Tool call {tool_call.function.name} failed: {output}")
+                if failed_searches is not None:
+                    failed_searches.append(tool_call.function.arguments)
+                content = "Error: the search failed."
+            else:
+                new_results = []
+                for r in output:
+                    key = ChatMistral.result_key(r)
+                    if key in packed and key not in seen:
+                        seen.add(key)
+                        new_results.append(packed[key])
+                content = (
+                    ChatMistral.tools_to_str(new_results)
+                    if new_results
+                    else "No other results than the ones above."
                 )
-            )
-            if isinstance(function_args, str):
-                try:
-                    function_args = json.loads(function_args)
-                except json.JSONDecodeError:
-                    yield "Error processing your request."
-                    return
-            function_result = self.names_to_functions[function_name](**function_args)
-            function_result_text = ChatMistral.tools_to_str(function_result)
-            self.messages.append(
+            tool_messages.append(
                 ToolMessage(
-                    name=function_name,
-                    content=function_result_text,
-                    tool_call_id=tool_call_data.id,
+                    name=tool_call.function.name,
+                    content=content,
+                    tool_call_id=tool_call.id,
                 )
             )
-            stream_response = self.client.chat.stream(
-                model=self.model, messages=self.messages, temperature=self.temperature
-            )
-            final_response = ""
-            for data in stream_response:
+        return tool_messages
+
+    async def stream_answer(self, messages: list) -> AsyncGenerator[str, None]:
+        """
+        Stream the answer of the model, without tools.
+        """
+        stream_response = await self.client.chat.stream_async(
+            model=self.model, messages=messages, temperature=self.temperature
+        )
+        async with stream_response:
+            async for data in stream_response:
                 chunk = data.data.choices[0]
                 if (
                     hasattr(chunk, "delta")
                     and hasattr(chunk.delta, "content")
                     and chunk.delta.content
                 ):
-                    final_response += chunk.delta.content
                     yield chunk.delta.content
                 elif hasattr(chunk, "content") and chunk.content:
-                    final_response += chunk.content
                     yield chunk.content
-            self.messages.append(AssistantMessage(content=final_response))
+
+    async def tool_answer(
+        self,
+        messages: list,
+        first_call: Optional[asyncio.Task] = None,
+        failed_searches: Optional[List[str]] = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        Answer with tool rounds: the model asks for searches, which run concurrently, then answers
+        with their results. After MAX_TOOL_ROUNDS rounds the model has to answer.
+
+        :param first_call: The first completion if it was already started.
+        :param failed_searches: See run_tools.
+        """
+        if first_call is None:
+            tool_calls, content = await self.first_completion(messages)
+        else:
+            tool_calls, content = await first_call
+        seen: set = set()
+        rounds = 1
+        while tool_calls:
+            logger.debug(f"tool calls: {tool_calls}")
+            messages.append(AssistantMessage(content=content, tool_calls=tool_calls))
+            messages.extend(await self.run_tools(tool_calls, seen, failed_searches))
+            if rounds >= self.max_tool_rounds:
+                break
+            rounds += 1
+            tool_calls = []
+            content = ""
+            async for chunk in self.stream_completion(messages, tool_calls):
+                content += chunk
+                yield chunk
+            if not tool_calls:
+                return
+
+        if not tool_calls:
+            if content:
+                yield content
+            return
+        async for chunk in self.stream_answer(messages):
+            yield chunk
+
+    async def chat(
+        self,
+        query: str,
+        session_id: Optional[str] = None,
+        failed_searches: Optional[List[str]] = None,
+    ) -> AsyncGenerator[str, None]:
+        """
+        Chat with the Mistral model.
+        It uses the official Mistral chat documentation with modifications to handle streaming tool calls.
+        All the completions are streamed with the async Mistral client, so concurrent chats don't block each other.
+
+        The CHAT_MODE decides how the context is retrieved:
+        - tool: the model writes the search query, then answers (two completions)
+        - retrieval: search with the question first, and answer in a single completion if the
+          context is good enough, else fall back to the tool mode
+        - parallel: like retrieval, but the first completion of the tool mode runs during the
+          search, so a fallback doesn't wait for it
+
+        :param query: The chat query.
+        :param session_id: The id of the visitor's conversation. Its history is loaded from
+            the conversation store and the new turn is saved at the end of the answer.
+        :param failed_searches: The queries of the searches that failed or only returned the
+            BM25 results are appended to this list, so the answer isn't cached.
+        :return: An async generator yielding chat responses.
+        """
+        start_time = time.perf_counter()
+        system_message = "You are a helpful assistant. Be straightforward and helpful. Keep your answers short and to the point. You answer in the language spoken to you."
+        history = self.conversations.get(self.domain, session_id) if session_id else []
+        # The messages are local to this request: concurrent chats never share them
+        messages = [
+            {"role": "system", "content": system_message},
+            *history,
+            {"role": "user", "content": query},
+        ]
+
+        path = "tool"
+        first_call = None
+        if self.mode == "tool":
+            chunks = self.tool_answer(messages, failed_searches=failed_searches)
         else:
-            self.messages.append(AssistantMessage(content=message_to_add))
+            if self.mode == "parallel":
+                first_call = asyncio.ensure_future(
+                    self.first_completion(list(messages))
+                )
+            results = await self.embeddings.asearch(query, failed_searches)
+            if self.context_is_good(results):
+                path = "retrieval"
+                if first_call is not None:
+                    first_call.cancel()
+                chunks = self.stream_answer(
+                    messages + self.retrieval_messages(query, results)
+                )
+            else:
+                path = "tool fallback"
+                chunks = self.tool_answer(messages, first_call, failed_searches)
+
+        message_to_add = ""
+        first_token_time = None
+        try:
+            async for chunk in chunks:
+                if first_token_time is None:
+                    first_token_time = time.perf_counter()
+                    observe_stage("ttft", first_token_time - start_time)
+                    logger.info(
+                        f"TTFT {self.mode} ({path}): {first_token_time - start_time:.3f}s"
+                    )
+                message_to_add += chunk
+                yield chunk
+        except Exception:
+            ERRORS.inc(stage="answer")
+            raise
+        finally:
+            if first_call is not None and not first_call.done():
+                first_call.cancel()
+
+        end_time = time.perf_counter()
+        observe_stage("answer", end_time - start_time)
+        if first_token_time is not None and end_time > first_token_time:
+            observe_stage("stream", end_time - first_token_time)
+            TOKENS_PER_SECOND.observe(
+                text_tokens(message_to_add) / (end_time - first_token_time)
+            )
+
+        if session_id:
+            self.conversations.save(
+                self.domain,
+                session_id,
+                history
+                + [
+                    {"role": "user", "content": query},
+                    {"role": "assistant", "content": message_to_add},
+                ],
+            )
 
 
 class MainExecute:
@@ -342,27 +1013,91 @@ class MainExecute:
         self.load = load
         self.scraper = ScraperInterface(domain=domain, depth=depth)  # scrape first
         self.embeddings = EmbeddingsVS(domain=domain)  # then upload the embeddings
-        self.chat = ChatMistral(domain=domain)  # then create the chat
+        self.chat = ChatMistral(
+            domain=domain, embeddings=self.embeddings
+        )  # then create the chat
 
         if self.load:
             self.scraper.run_crawler()  # run the scraper
             logger.info("Finished scraping.")
             self.embeddings.upload_embeddings()  # upload the embeddings
             logger.info("Finished uploading embeddings.")
+        else:
+            self.embeddings.load_retriever()  # reuse the existing collection
+
+        self.chat_log = get_chat_log()
+
+        # Optional cache of answers to near-duplicate questions
+        self.answer_cache = (
+            SemanticAnswerCache(
+                max_size=int(os.getenv("ANSWER_CACHE_SIZE", 256)),
+                ttl=float(os.getenv("ANSWER_CACHE_TTL", 86400)),
+                threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+            )
+            if os.getenv("ANSWER_CACHE", "false").lower() == "true"
+            else None
+        )
+
+    async def replay(self, answer: str) -> AsyncGenerator[str, None]:
+        """
+        Stream a cached answer word by word, like an answer coming from the model.
+        """
+        for chunk in re.findall(r"\s*\S+\s*", answer):
+            yield chunk
 
-    def ask(self, question: str):
+    async def ask(
+        self, question: str, session_id: Optional[str] = None
+    ) -> AsyncGenerator[str, None]:
         """
         Ask a question to the chatbot based on a url.
         """
         try:
             output = ""
+            # Answers are only reused for the first question of a conversation,
+            # later ones depend on the history
+            embedding = None
+            if self.answer_cache is not None and not (
+                session_id and self.chat.conversations.get(self.domain, session_id)
+            ):
+                embedding = await self.embeddings.aembed_query(question)
+                answer = self.answer_cache.get(embedding, self.embeddings.index_version)
+                cache_lookup("answers", answer is not None)
+                if answer is not None:
+                    async for chunk in self.replay(answer):
+                        output += chunk
+                        yield chunk
+                    if session_id:
+                        self.chat.conversations.save(
+                            self.domain,
+                            session_id,
+                            [
+                                {"role": "user", "content": question},
+                                {"role": "assistant", "content": answer},
+                            ],
+                        )
+                    self.chat_log.log(input=question, output=output)
+                    return
+
             # Stream the response
-            for chunk in self.chat.chat(question):
+            failed_searches: List[str] = []
+            async for chunk in self.chat.chat(
+                question, session_id=session_id, failed_searches=failed_searches
+            ):
                 output += chunk
                 yield chunk  # Continue yielding chunks as they arrive
 
-            # Log the input and output using phospho
-            phospho.log(input=question, output=output)
+            # An answer written without the full search results isn't reused
+            if embedding is not None and output and not failed_searches:
+                self.answer_cache.set(embedding, self.embeddings.index_version, output)
+
+            # Log the input and output, sent to phospho in the background
+            self.chat_log.log(input=question, output=output)
 
+        except (asyncio.CancelledError, GeneratorExit):
+            # The visitor left: the partial answer is logged as cancelled
+            self.chat_log.log(
+                input=question, output=output, metadata={"status": "cancelled"}
+            )
+            raise
         except KeyboardInterrupt:
             logger.info("Exiting program.")
@@ -6,7 +6,12 @@
 import scrapy
 
 
-class Scraper1Item(scrapy.Item):
-    # define the fields for your item here like:
-    # name = scrapy.Field()
-    pass
+class PageItem(scrapy.Item):
+    # A page record of the PageStore, its chunks are embedded by the EmbeddingPipeline
+    url = scrapy.Field()
+    id = scrapy.Field()
+    full_text = scrapy.Field()
+    content_hash = scrapy.Field()
+    chunked_text = scrapy.Field()
+    last_time_crawled = scrapy.Field()
+    status = scrapy.Field()
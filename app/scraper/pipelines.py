@@ -4,10 +4,144 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
 
+import time
+import asyncio
+from typing import Dict, List, Tuple
+
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
+from scrapy.utils.defer import deferred_from_coro
+
+
+class EmbeddingPipeline:
+    """
+    Embed the chunks of the crawled pages outside of the spider callbacks.
+
+    Chunks are buffered across pages and sent in batches of EMBEDDING_BATCH_SIZE, with at most
+    EMBEDDING_CONCURRENCY requests in flight, so crawling and embedding overlap.
+    A failed batch is retried with exponential backoff (rate limits), and its pages are stored
+    without embeddings if it keeps failing: EmbeddingsVS embeds them when indexing.
+    A page is written to the spider's PageStore once all its chunks are embedded.
+    """
+
+    def __init__(
+        self, batch_size: int, concurrency: int, max_retries: int, backoff: float
+    ):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(
+            batch_size=crawler.settings.getint("EMBEDDING_BATCH_SIZE", 32),
+            concurrency=crawler.settings.getint("EMBEDDING_CONCURRENCY", 4),
+            max_retries=crawler.settings.getint("EMBEDDING_MAX_RETRIES", 5),
+            backoff=crawler.settings.getfloat("EMBEDDING_BACKOFF", 1),
+        )
 
+    def open_spider(self, spider):
+        # url -> [page record, number of chunks left to embed]
+        self.pages: Dict[str, list] = {}
+        # (url, chunk index, chunk text) waiting for the next batch
+        self.buffer: List[Tuple[str, int, str]] = []
+        self.tasks = set()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.embedded_chunks = 0
+        self.start_time = time.monotonic()
+        spider.embeddings_model.embed_batch_size = self.batch_size
 
-class Scraper1Pipeline:
-    def process_item(self, item, spider):
+    async def process_item(self, item, spider):
+        record = ItemAdapter(item).asdict()
+        chunks = record["chunked_text"]["embeddings"]
+        if record["url"] in self.pages:
+            # Another response of the page is being embedded, it isn't in the database
+            # yet so the spider saw this one as new: keep the first one
+            spider.logger.info(
+                f"{record['url']} is already being embedded, skipping it"
+            )
+            return item
+        if not chunks:
+            spider.database.put(record)
+            return item
+        self.pages[record["url"]] = [record, len(chunks)]
+        self.buffer.extend(
+            (record["url"], i, chunk["chunk_text"]) for i, chunk in enumerate(chunks)
+        )
+        while len(self.buffer) >= self.batch_size:
+            await self.send_batch(spider)
         return item
+
+    async def send_batch(self, spider):
+        """
+        Start the embedding of the next batch in the background.
+        Waits when EMBEDDING_CONCURRENCY batches are already in flight, which slows down
+        the crawl instead of buffering an unbounded number of chunks.
+        """
+        batch, self.buffer = (
+            self.buffer[: self.batch_size],
+            self.buffer[self.batch_size :],
+        )
+        await self.semaphore.acquire()
+        task = asyncio.ensure_future(self.embed_batch(batch, spider))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def embed_batch(self, batch: List[Tuple[str, int, str]], spider):
+        try:
+            embeddings = None
+            for attempt in range(self.max_retries + 1):
+                try:
+                    embeddings = (
+                        await spider.embeddings_model.aget_text_embedding_batch(
+                            [text for _, _, text in batch]
+                        )
+                    )
+                    break
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        spider.logger.error(
+                            f"Failed to embed {len(batch)} chunks, storing them without embeddings: {str(e)}"
+                        )
+                    else:
+                        delay = self.backoff * 2**attempt
+                        spider.logger.warning(
+                            f"Embedding request failed ({str(e)}), retrying in {delay}s"
+                        )
+                        await asyncio.sleep(delay)
+        finally:
+            self.semaphore.release()
+
+        for i, (url, chunk_index, _) in enumerate(batch):
+            page = self.pages[url]
+            page[0]["chunked_text"]["embeddings"][chunk_index]["embedding"] = (
+                embeddings[i] if embeddings else None
+            )
+            page[1] -= 1
+            if page[1] == 0:
+                spider.database.put(page[0])
+                del self.pages[url]
+
+        if embeddings:
+            self.embedded_chunks += len(batch)
+            spider.crawler.stats.inc_value("embedding/chunks", len(batch))
+            elapsed = time.monotonic() - self.start_time
+            spider.logger.info(
+                f"Embedded {self.embedded_chunks} chunks, {self.embedded_chunks / elapsed:.1f} chunks/sec"
+            )
+
+    async def flush(self, spider):
+        while self.buffer:
+            await self.send_batch(spider)
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+        elapsed = time.monotonic() - self.start_time
+        spider.logger.info(
+            f"Embedding finished: {self.embedded_chunks} chunks in {elapsed:.1f}s, "
+            f"{self.embedded_chunks / elapsed:.1f} chunks/sec"
+        )
+
+    def close_spider(self, spider):
+        # The spider exports its database in closed(), after the pipelines are closed
+        return deferred_from_coro(self.flush(spider))
@@ -62,9 +62,15 @@ ROBOTSTXT_OBEY = True
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
-# ITEM_PIPELINES = {
-#    "scraper.pipelines.Scraper1Pipeline": 300,
-# }
+ITEM_PIPELINES = {
+    "scraper.pipelines.EmbeddingPipeline": 300,
+}
+
+# Embedding of the page chunks, see scraper.pipelines.EmbeddingPipeline
+EMBEDDING_BATCH_SIZE = 32  # chunks per embedding request
+EMBEDDING_CONCURRENCY = 4  # embedding requests in flight
+EMBEDDING_MAX_RETRIES = 5  # retries of a batch, with exponential backoff
+EMBEDDING_BACKOFF = 1  # seconds before the first retry
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
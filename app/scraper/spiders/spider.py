@@ -7,9 +7,11 @@ import re
 import datetime
 import hashlib
 import os
-import pandas
 import uuid
+from collections import Counter
 from llama_index.embeddings.mistralai import MistralAIEmbedding
+from scraper.items import PageItem
+from scraper.store import PageStore
 
 
 class TextContentSpider(CrawlSpider):
@@ -33,6 +35,7 @@ class TextContentSpider(CrawlSpider):
         self.chunk_size = 1024
         self.db_path = db_path
         self.db_file = os.path.join(self.db_path, f"{domain}.json")
+        self.store_file = os.path.join(self.db_path, f"{domain}.jsonl")
         self.embeddings_model = MistralAIEmbedding(
             api_key=os.getenv("MISTRAL_API_KEY"),
             model_name="mistral-embed",
@@ -42,63 +45,54 @@ class TextContentSpider(CrawlSpider):
         # browser config
         self.browser_headless = False
 
+        # Hashes of the sentences of the stored pages, see index_sentences
+        self.sentence_hashes = Counter()
+        self.page_sentences = {}
+        # Urls of the pages found by this crawl, the others are removed when it finishes
+        self.seen_urls = set()
+        self.failed_urls = set()
         self.load_database()
 
-    def update_database(self):
-        with open(self.db_file, "r") as file:
-            db_data = json.load(file)
-        file.close()
-        with open(self.db_file, "w") as file:
-            db_data["data"] = self.database.to_dict(orient="records")
-            self.database = pandas.DataFrame(data=db_data["data"])
-            json.dump(db_data, file, indent=4)
-        file.close()
-
     def start_requests(self):
         for url in self.start_urls:
             yield scrapy.Request(url, self.parse_response, meta={"depth": 0})
 
+    def database_header(self) -> dict:
+        return {
+            "url": self.start_urls,
+            "time": str(datetime.datetime.now()),
+            "config": {
+                "depth": self.depth_limit,
+                "chunk_size": self.chunk_size,
+                "embedding_model": self.embeddings_model_name,
+                "allowed_domains": self.allowed_domains,
+            },
+        }
+
     def load_database(self):
         """
         here, it also depends if we want to take the chunk size in counts, i assume we just skip this
+
+        The pages are kept in an append-only PageStore (data/{domain}.jsonl).
+        data/{domain}.json is only written when the spider closes, for EmbeddingsVS.
         """
-        if os.path.exists(self.db_file):
+        store_exists = os.path.exists(self.store_file)
+        self.database = PageStore(self.store_file)
+        if not store_exists and os.path.exists(self.db_file):
+            # Import the pages of a database written before the page store
             try:
                 self.logger.info(f"Loading database from {self.db_file}")
                 with open(self.db_file, "r") as file:
-                    self.database = json.load(file)
-                    self.database = pandas.DataFrame(data=self.database["data"])
-                file.close()
-            except:
+                    for record in json.load(file)["data"]:
+                        self.database.put(record)
+            except Exception:
                 self.logger.info(f"Error loading database from {self.db_file}")
-                self.database = pandas.DataFrame()
-        else:
+        elif not os.path.exists(self.db_file):
             self.logger.info(f"No database found at {self.db_file}, creating new one.")
-            self.database = pandas.DataFrame(
-                columns=[
-                    "url",
-                    "id",
-                    "full_text",
-                    "content_hash",
-                    "chunked_text",
-                    "last_time_crawled",
-                    "status",
-                ]
-            )
-            headers_ = {
-                "url": [self.start_urls[0]],
-                "time": str(datetime.datetime.now()),
-                "config": {
-                    "depth": self.depth_limit,
-                    "chunk_size": self.chunk_size,
-                    "embedding_model": self.embeddings_model_name,
-                    "allowed_domains": [self.allowed_domains[0]],
-                },
-                "data": [],
-            }
-            with open(self.db_file, "w") as file:
-                json.dump(headers_, file, indent=4)
-            file.close()
+            self.database.export_json(self.db_file, self.database_header())
+
+        for record in self.database.records():
+            self.index_sentences(record["url"], record["full_text"])
 
     def parse_text(self, text: str):
         soup = BeautifulSoup(text, "html.parser")
@@ -111,40 +105,59 @@ class TextContentSpider(CrawlSpider):
 
         return cleaned_text
 
-    def get_embeddings(self, text: str, url: str) -> dict:
-        chunks = self.chunk_text(text)
-        embeddings = []
-        embedeed_sentences = self.embeddings_model.encode(
-            chunks
-        ).tolist()  # Converted ndarray to list
+    def get_chunks(self, text: str, url: str) -> dict:
+        """
+        Chunk the text of a page. The chunks are embedded by the EmbeddingPipeline.
+        The chunk text is embedded exactly as it is indexed, so EmbeddingsVS can reuse the vectors.
+        """
+        chunks = [url + ": " + chunk for chunk in self.chunk_text(text)]
         embeddings = [
             {
-                "chunk_text": url + ": " + chunk,
-                "embedding": embedeed_sentences[i],
+                "chunk_text": chunk,
+                "embedding": None,
                 "id": str(uuid.uuid4()),
             }
-            for i, chunk in enumerate(chunks)
+            for chunk in chunks
         ]
 
         return {"embeddings": embeddings}
 
+    def split_sentences(self, text: str) -> list:
+        return re.split(r"(?<=[.!?]) +", text)
+
+    def index_sentences(self, url: str, text: str):
+        """
+        Add the sentences of a stored page to the sentence hash index, so that chunk_text
+        checks if a sentence is already in the database in O(1) instead of scanning every page.
+        The hashes are counted and kept per url, so the previous version of a page can be
+        removed, see forget_sentences.
+        """
+        self.forget_sentences(url)
+        hashes = {hash(s) for s in self.split_sentences(text)}
+        self.page_sentences[url] = hashes
+        self.sentence_hashes.update(hashes)
+
+    def forget_sentences(self, url: str):
+        """
+        Remove the sentences of a page from the index, before it is chunked again.
+        The sentences shared with other pages stay known.
+        """
+        for sentence_hash in self.page_sentences.pop(url, ()):
+            self.sentence_hashes[sentence_hash] -= 1
+            if self.sentence_hashes[sentence_hash] <= 0:
+                del self.sentence_hashes[sentence_hash]
+
+    def is_known_sentence(self, sentence: str) -> bool:
+        return hash(sentence) in self.sentence_hashes
+
     def chunk_text(self, text: str) -> list:
         chunks = []
         current_chunk = ""
-        sentences = re.split(r"(?<=[.!?]) +", text)
+        sentences = self.split_sentences(text)
         for sentence in sentences:
-            try:
-                # f sentence in self.database['full_text'].values:
-                if any(
-                    sentence in text
-                    for text in self.database["full_text"].values.tolist()
-                ):
-                    self.logger.warning(
-                        f"Sentence already in database, skipping chunking."
-                    )
-                    continue
-            except Exception:
-                pass
+            if self.is_known_sentence(sentence):
+                self.logger.warning(f"Sentence already in database, skipping chunking.")
+                continue
 
             if len(current_chunk + sentence) <= self.chunk_size:
                 current_chunk += sentence + " "
@@ -184,14 +197,9 @@ class TextContentSpider(CrawlSpider):
             self.logger.info(f"Page is not empty, continue")
 
         content_hash = hashlib.sha256(processed_text.encode("utf-8")).hexdigest()
-        try:
-            filtered_df = self.database[self.database["url"] == response.url]
-            url_entry = filtered_df.iloc[0] if not filtered_df.empty else None
-        except Exception as e:
-            self.logger.error(f"Error accessing database entry: {str(e)}")
-            url_entry = None
+        url_entry = self.database.get(response.url)
 
-        # print(url_entry)
+        self.seen_urls.add(response.url)
         if url_entry is not None:
             db_id = url_entry["id"]
             last_time_crawled = url_entry["last_time_crawled"]
@@ -199,40 +207,33 @@ class TextContentSpider(CrawlSpider):
                 self.logger.info(
                     f"Content hash mismatch for {response.url}, updating entry."
                 )
-                self.database.loc[
-                    self.database["url"] == response.url,
-                    [
-                        "full_text",
-                        "content_hash",
-                        "chunked_text",
-                        "last_time_crawled",
-                        "status",
-                    ],
-                ] = [
-                    processed_text,
-                    content_hash,
-                    self.get_embeddings(processed_text, response.url),
-                    last_time_crawled,
-                    status_code,
-                ]
+                # The page is chunked again without its own previous sentences
+                self.forget_sentences(response.url)
+                yield PageItem(
+                    url=response.url,
+                    id=db_id,
+                    full_text=processed_text,
+                    content_hash=content_hash,
+                    chunked_text=self.get_chunks(processed_text, response.url),
+                    last_time_crawled=last_time_crawled,
+                    status=status_code,
+                )
+                self.index_sentences(response.url, processed_text)
             else:
                 self.logger.info(f"URL {response.url} is already in the database.")
         else:
             self.logger.info(f"New URL {response.url}, adding to database.")
-            new_entry = {
-                "url": response.url,
-                "id": str(uuid.uuid4()),
-                "full_text": processed_text,
-                "content_hash": content_hash,
-                "chunked_text": self.get_embeddings(processed_text, response.url),
-                "last_time_crawled": str(datetime.datetime.now()),
-                "status": status_code,
-            }
-            self.database = pandas.concat(
-                [self.database, pandas.DataFrame([new_entry])], ignore_index=True
+            # Stored in the database by the EmbeddingPipeline once its chunks are embedded
+            yield PageItem(
+                url=response.url,
+                id=str(uuid.uuid4()),
+                full_text=processed_text,
+                content_hash=content_hash,
+                chunked_text=self.get_chunks(processed_text, response.url),
+                last_time_crawled=str(datetime.datetime.now()),
+                status=status_code,
             )
-
-            self.update_database()
+            self.index_sentences(response.url, processed_text)
 
         links = LinkExtractor(allow=()).extract_links(response)
         for link in links:
@@ -246,27 +247,38 @@ class TextContentSpider(CrawlSpider):
                 )
 
     def handle_error(self, failure):
-        if failure.value.response.status == 429:
+        response = getattr(failure.value, "response", None)
+        if response is None or response.status not in (404, 410):
+            # The page is kept, it may only be unavailable for now
+            self.failed_urls.add(failure.request.url)
+        if response is not None and response.status == 429:
             self.logger.error(
                 f"Received 429 Too Many Requests from {failure.request.url}"
             )
             # Optionally, you can customize retry logic here
 
+    def remove_unseen_pages(self):
+        """
+        Remove the pages that this crawl didn't find anymore, so they are deleted from the
+        index. Only called when the crawl finished, an interrupted crawl saw only part of the site.
+        """
+        removed = [
+            url
+            for url in self.database.urls()
+            if url not in self.seen_urls and url not in self.failed_urls
+        ]
+        for url in removed:
+            self.database.delete(url)
+        if removed:
+            self.logger.info(f"Removed {len(removed)} pages not found anymore")
+
     def closed(self, reason):
-        # self.update_database()
-        with open(self.db_file, "w") as f:
-            output_data = {
-                "url": self.start_urls,
-                "time": str(datetime.datetime.now()),
-                "config": {
-                    "depth": self.depth_limit,
-                    "chunk_size": self.chunk_size,
-                    "embedding_model": self.embeddings_model_name,
-                    "allowed_domains": self.allowed_domains,
-                },
-                "data": self.database.to_dict(orient="records"),
-            }
-            json.dump(output_data, f, indent=4)
+        if reason == "finished":
+            self.remove_unseen_pages()
+        # Drop the outdated records and export the JSON read by EmbeddingsVS
+        self.database.compact()
+        self.database.export_json(self.db_file, self.database_header())
+        self.database.close()
         self.logger.info(f"Closed spider with reason: {reason}")
         self.logger.info(f"Total requests sent: {len(self.results)}")
         self.logger.info(f"Status code counts: {self.status_counts}")
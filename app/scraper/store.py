@@ -0,0 +1,110 @@
+import os
+import json
+from typing import Dict, Iterator, List, Optional
+
+
+class PageStore:
+    """
+    Append-only JSONL store of the pages crawled by the spider.
+
+    Every put appends one line, and an in-memory index maps each url to the offset of its
+    latest record, so lookups and appends are O(1) per page whatever the size of the site.
+    A removed page is a {"url": ..., "deleted": true} line.
+    Outdated records are dropped by compact, and export_json writes the data/{domain}.json
+    format read by EmbeddingsVS.
+    """
+
+    # Fields kept in memory for the lookups, the texts and embeddings stay on disk
+    index_fields = ("id", "content_hash", "last_time_crawled", "status")
+
+    def __init__(self, path: str):
+        """
+        :param path: Path of the JSONL file, created if it doesn't exist.
+        """
+        self.path = path
+        self.index: Dict[str, dict] = {}
+        self.offsets: Dict[str, int] = {}
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                offset = f.tell()
+                for line in iter(f.readline, b""):
+                    if line.strip():
+                        self.add_to_index(json.loads(line), offset)
+                    offset = f.tell()
+        self.file = open(self.path, "ab")
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def add_to_index(self, record: dict, offset: int):
+        if record.get("deleted"):
+            self.offsets.pop(record["url"], None)
+            self.index.pop(record["url"], None)
+            return
+        self.offsets[record["url"]] = offset
+        self.index[record["url"]] = {
+            field: record.get(field) for field in self.index_fields
+        }
+
+    def get(self, url: str) -> Optional[dict]:
+        """
+        :return: The indexed fields of the latest record of the url, or None if it was never crawled.
+        """
+        return self.index.get(url)
+
+    def put(self, record: dict):
+        """
+        Append a page record. It replaces the previous record of the same url.
+        """
+        offset = self.file.tell()
+        self.file.write(json.dumps(record).encode("utf-8") + b"\n")
+        self.add_to_index(record, offset)
+
+    def urls(self) -> List[str]:
+        return list(self.offsets)
+
+    def delete(self, url: str):
+        """
+        Remove a page, its records are dropped by compact.
+        """
+        if url in self.offsets:
+            self.put({"url": url, "deleted": True})
+
+    def records(self) -> Iterator[dict]:
+        """
+        Iterate over the latest record of every url.
+        """
+        self.file.flush()
+        with open(self.path, "rb") as f:
+            for offset in self.offsets.values():
+                f.seek(offset)
+                yield json.loads(f.readline())
+
+    def compact(self):
+        """
+        Rewrite the file with only the latest record of every url.
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for record in self.records():
+                f.write(json.dumps(record).encode("utf-8") + b"\n")
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        self.__init__(self.path)
+
+    def export_json(self, path: str, header: dict):
+        """
+        Export the pages to the JSON format of data/{domain}.json, {**header, "data": [records]}.
+        The records are streamed to the file, they are never all loaded in memory.
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps({**header, "data": []})[:-2])
+            for i, record in enumerate(self.records()):
+                f.write(", " if i else "")
+                json.dump(record, f)
+            f.write("]}")
+        os.replace(tmp_path, path)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from loguru import logger
+from context import text_tokens
+
+
+def count_tokens(message: Dict[str, str]) -> int:
+    """
+    Rough token count of a message: its text, plus a few tokens for the role.
+    """
+    return text_tokens(message.get("content") or "") + 4
+
+
+def trim_history(
+    messages: List[Dict[str, str]], max_tokens: int
+) -> List[Dict[str, str]]:
+    """
+    Keep the most recent messages of a conversation that fit in the token budget.
+    Messages are dropped by user/assistant pairs so the history never starts with an answer.
+
+    :param messages: The conversation history, oldest first.
+    :param max_tokens: The token budget of the history.
+    :return: The trimmed history.
+    """
+    total = sum(count_tokens(message) for message in messages)
+    start = 0
+    while total > max_tokens and start < len(messages):
+        total -= count_tokens(messages[start])
+        start += 1
+    while start < len(messages) and messages[start]["role"] != "user":
+        start += 1
+    return messages[start:]
+
+
+class ConversationStore(ABC):
+    """
+    Session-keyed conversation history.
+    A session is scoped to a domain, so the same session id on two websites gives two conversations.
+    """
+
+    def __init__(self, ttl: float, max_tokens: int):
+        """
+        :param ttl: Idle time in seconds after which a session is evicted.
+        :param max_tokens: Token budget of the history kept per session.
+        """
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+
+    @abstractmethod
+    def get(self, domain: str, session_id: str) -> List[Dict[str, str]]:
+        """
+        :return: The history of the session, empty if it is unknown or expired.
+        """
+
+    @abstractmethod
+    def save(self, domain: str, session_id: str, messages: List[Dict[str, str]]):
+        """
+        Replace the history of the session, trimmed to the token budget.
+        """
+
+    @abstractmethod
+    def evict_idle(self) -> int:
+        """
+        :return: The number of sessions evicted because they were idle.
+        """
+
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    LRU + TTL conversation store kept in the process memory.
+    """
+
+    def __init__(self, ttl: float, max_tokens: int, max_sessions: int):
+        """
+        :param max_sessions: Maximum number of sessions kept, the least recently used are evicted first.
+        """
+        super().__init__(ttl=ttl, max_tokens=max_tokens)
+        self.max_sessions = max_sessions
+        self.sessions: OrderedDict[
+            Tuple[str, str], Tuple[float, List[Dict[str, str]]]
+        ] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, domain: str, session_id: str) -> List[Dict[str, str]]:
+        key = (domain, session_id)
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry is None:
+                return []
+            last_access, messages = entry
+            if time.monotonic() - last_access > self.ttl:
+                del self.sessions[key]
+                return []
+            self.sessions.move_to_end(key)
+            return list(messages)
+
+    def save(self, domain: str, session_id: str, messages: List[Dict[str, str]]):
+        key = (domain, session_id)
+        with self.lock:
+            self.sessions[key] = (
+                time.monotonic(),
+                trim_history(messages, self.max_tokens),
+            )
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def evict_idle(self) -> int:
+        deadline = time.monotonic() - self.ttl
+        with self.lock:
+            # Sessions are ordered by last access, so idle ones are at the front
+            evicted = 0
+            while self.sessions:
+                key, (last_access, _) = next(iter(self.sessions.items()))
+                if last_access > deadline:
+                    break
+                del self.sessions[key]
+                evicted += 1
+        return evicted
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Conversation store persisted in a SQLite database, shared by all the workers of the host.
+    """
+
+    def __init__(self, ttl: float, max_tokens: int, path: str):
+        """
+        :param path: Path of the SQLite database file.
+        """
+        super().__init__(ttl=ttl, max_tokens=max_tokens)
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                domain TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (domain, session_id)
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS conversations_updated_at ON conversations (updated_at)"
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+    def get(self, domain: str, session_id: str) -> List[Dict[str, str]]:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT messages FROM conversations WHERE domain = ? AND session_id = ? AND updated_at > ?",
+                (domain, session_id, time.time() - self.ttl),
+            ).fetchone()
+        return json.loads(row[0]) if row else []
+
+    def save(self, domain: str, session_id: str, messages: List[Dict[str, str]]):
+        messages = trim_history(messages, self.max_tokens)
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO conversations (domain, session_id, messages, updated_at) VALUES (?, ?, ?, ?)",
+                (domain, session_id, json.dumps(messages), time.time()),
+            )
+            self.connection.commit()
+
+    def evict_idle(self) -> int:
+        with self.lock:
+            cursor = self.connection.execute(
+                "DELETE FROM conversations WHERE updated_at <= ?",
+                (time.time() - self.ttl,),
+            )
+            self.connection.commit()
+        return cursor.rowcount
+
+
+conversation_store: Optional[ConversationStore] = None
+
+
+def get_conversation_store() -> ConversationStore:
+    """
+    Get the process-wide conversation store, configured with environment variables:
+    - CONVERSATION_STORE: "memory" (default) or "sqlite"
+    - CONVERSATION_DB_PATH: path of the SQLite database (default data/conversations.db)
+    - CONVERSATION_TTL: idle seconds before a session is evicted (default 1800)
+    - CONVERSATION_MAX_TOKENS: token budget of the history of a session (default 2000)
+    - CONVERSATION_MAX_SESSIONS: maximum number of sessions kept in memory (default 10000)
+    """
+    global conversation_store
+    if conversation_store is None:
+        ttl = float(os.getenv("CONVERSATION_TTL", 1800))
+        max_tokens = int(os.getenv("CONVERSATION_MAX_TOKENS", 2000))
+        if os.getenv("CONVERSATION_STORE", "memory") == "sqlite":
+            path = os.getenv(
+                "CONVERSATION_DB_PATH", os.path.join("data", "conversations.db")
+            )
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            logger.info(f"Using SQLite conversation store: {path}")
+            conversation_store = SQLiteConversationStore(
+                ttl=ttl, max_tokens=max_tokens, path=path
+            )
+        else:
+            conversation_store = InMemoryConversationStore(
+                ttl=ttl,
+                max_tokens=max_tokens,
+                max_sessions=int(os.getenv("CONVERSATION_MAX_SESSIONS", 10000)),
+            )
+    return conversation_store
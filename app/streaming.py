@@ -0,0 +1,255 @@
+import json
+import asyncio
+from contextvars import ContextVar
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional
+from loguru import logger
+from context import text_tokens
+from metrics import ANSWERS, TOKENS_SAVED
+
+
+class StreamStats:
+    """
+    Counters of the streamed answers. The tokens an answer would still have generated are
+    unknown when it is cancelled, they are estimated with the average length of the
+    completed answers.
+    """
+
+    def __init__(self):
+        self.completed = 0
+        self.cancelled = 0
+        self.completed_tokens = 0
+        self.cancelled_tokens = 0
+        self.tokens_saved = 0
+
+    def average_tokens(self) -> float:
+        return self.completed_tokens / self.completed if self.completed else 0.0
+
+    def complete(self, tokens: int):
+        self.completed += 1
+        self.completed_tokens += tokens
+        ANSWERS.inc(status="completed")
+
+    def cancel(self, tokens: int):
+        saved = max(round(self.average_tokens()) - tokens, 0)
+        self.cancelled += 1
+        self.cancelled_tokens += tokens
+        self.tokens_saved += saved
+        ANSWERS.inc(status="cancelled")
+        TOKENS_SAVED.inc(saved)
+        logger.info(
+            f"Answer cancelled after {tokens} tokens, about {saved} tokens saved"
+        )
+
+    def stats(self) -> dict:
+        return {
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "cancelled_tokens": self.cancelled_tokens,
+            "tokens_saved": self.tokens_saved,
+            "average_tokens": round(self.average_tokens(), 1),
+        }
+
+
+stream_stats = StreamStats()
+
+# Pages of the search results sent to the model for the current request, for the sources event
+request_sources: ContextVar[Optional[List[dict]]] = ContextVar(
+    "request_sources", default=None
+)
+
+
+def add_sources(results: List[dict]):
+    sources = request_sources.get()
+    if sources is None:
+        return
+    known = {source["url"] for source in sources}
+    for result in results:
+        if result.get("url") and result["url"] not in known:
+            known.add(result["url"])
+            sources.append({"url": result["url"]})
+
+
+async def wait_for_disconnect(
+    is_disconnected: Callable[[], Awaitable[bool]], poll_interval: float
+):
+    while not await is_disconnected():
+        await asyncio.sleep(poll_interval)
+
+
+async def cancel_on_disconnect(
+    chunks: AsyncGenerator[str, None],
+    is_disconnected: Callable[[], Awaitable[bool]],
+    poll_interval: float = 0.25,
+    stats: Optional[StreamStats] = None,
+) -> AsyncGenerator[str, None]:
+    """
+    Stream the chunks of an answer until the client disconnects. The disconnection is
+    checked while waiting for the next chunk, so a visitor closing the chat bubble stops
+    the generation right away, even during the searches or a silent tool call completion.
+    The chunks generator is then closed, which closes the upstream Mistral stream.
+
+    :param chunks: The chunks of the answer.
+    :param is_disconnected: Request.is_disconnected of the client request.
+    :param poll_interval: Seconds between two checks of the connection.
+    :param stats: Counters updated when the answer is completed or cancelled.
+    """
+    stats = stats or stream_stats
+    disconnect = asyncio.ensure_future(
+        wait_for_disconnect(is_disconnected, poll_interval)
+    )
+    next_chunk = None
+    tokens = 0
+    try:
+        while True:
+            next_chunk = asyncio.ensure_future(chunks.__anext__())
+            await asyncio.wait(
+                {next_chunk, disconnect}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not next_chunk.done():
+                stats.cancel(tokens)
+                return
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                stats.complete(tokens)
+                return
+            tokens += text_tokens(chunk) or 1
+            yield chunk
+    except (asyncio.CancelledError, GeneratorExit):
+        # The server stopped the response first
+        stats.cancel(tokens)
+        raise
+    finally:
+        disconnect.cancel()
+        if next_chunk is not None and not next_chunk.done():
+            # The chunks generator is running in this task: let it close before aclose
+            next_chunk.cancel()
+            await asyncio.wait({next_chunk})
+        await chunks.aclose()
+
+
+async def prefetch(chunks: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+    """
+    Wait for the first chunk of an answer, so the response headers can describe the stages
+    before it, and errors before it can still be returned as an error status.
+
+    :return: A generator of all the chunks, the first one included.
+    """
+    try:
+        first_chunk: Optional[str] = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+
+    async def stream() -> AsyncGenerator[str, None]:
+        try:
+            if first_chunk is not None:
+                yield first_chunk
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            await chunks.aclose()
+
+    return stream()
+
+
+async def coalesce(
+    chunks: AsyncGenerator[str, None], max_chars: int, max_delay: float
+) -> AsyncGenerator[str, None]:
+    """
+    Merge the deltas of an answer into fewer, larger chunks. The first delta is sent right
+    away, so the time to first token doesn't change; the next ones are buffered until there
+    are max_chars characters or the oldest has waited max_delay seconds.
+    """
+    loop = asyncio.get_running_loop()
+    buffer: List[str] = []
+    size = 0
+    deadline = None
+    first = True
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+            if done:
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    # The answer failed: send what it already generated
+                    if buffer:
+                        yield "".join(buffer)
+                    raise
+                finally:
+                    next_chunk = None
+                if first:
+                    first = False
+                    yield chunk
+                    continue
+                buffer.append(chunk)
+                size += len(chunk)
+                if deadline is None:
+                    deadline = loop.time() + max_delay
+                if size < max_chars:
+                    continue
+            yield "".join(buffer)
+            buffer, size, deadline = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if next_chunk is not None and not next_chunk.done():
+            next_chunk.cancel()
+            await asyncio.wait({next_chunk})
+        await chunks.aclose()
+
+
+def format_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def sse_events(
+    chunks: AsyncGenerator[str, None],
+    sources: List[dict],
+    timings: Dict[str, float],
+    max_chars: int = 64,
+    max_delay: float = 0.05,
+) -> AsyncGenerator[str, None]:
+    """
+    Stream an answer as server-sent events:
+    - sources: the pages of the search results given to the model, before the first token
+      and again if a later search adds pages,
+    - token: {"text": ...} a part of the answer, see coalesce,
+    - done: {"timings": ...} the duration of the stages in milliseconds, at the end,
+    - error: {"message": ...} if the answer failed after its first token.
+
+    :param sources: The request_sources of the request, filled during the answer.
+    :param timings: The request_timings of the request.
+    :param max_chars: See coalesce, 0 sends every delta in its own event.
+    :param max_delay: See coalesce.
+    """
+    yield format_event("sources", sources)
+    sent = len(sources)
+    if max_chars > 0 and max_delay > 0:
+        chunks = coalesce(chunks, max_chars, max_delay)
+    try:
+        async for chunk in chunks:
+            if len(sources) > sent:
+                yield format_event("sources", sources[sent:])
+                sent = len(sources)
+            yield format_event("token", {"text": chunk})
+    except Exception as e:
+        logger.error(f"Answer failed during the stream: {str(e)}")
+        yield format_event("error", {"message": "The answer failed, please try again."})
+        return
+    finally:
+        await chunks.aclose()
+    yield format_event(
+        "done",
+        {
+            "timings": {
+                stage: round(seconds * 1000, 1) for stage, seconds in timings.items()
+            }
+        },
+    )
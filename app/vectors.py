@@ -0,0 +1,145 @@
+import os
+import json
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Set
+from loguru import logger
+
+
+class LocalVectorIndex:
+    """
+    In-process vector search over the chunk embeddings of a domain, without a Qdrant server.
+
+    The normalized vectors are saved as a float16 matrix ({path}.vectors.npy, half the size of
+    float32) and memory-mapped when loaded, so loading a domain is immediate and only the pages
+    of the matrix that are read stay in memory. The chunks (id, url, content hash and text) are
+    saved in the same order in {path}.vectors.json.
+    A search is an exact cosine top-k: a matrix-vector product with NumPy.
+    """
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        chunks: List[dict],
+        max_float32_mb: float = 0,
+    ):
+        """
+        :param vectors: The normalized float16 vectors, one row per chunk.
+        :param chunks: The chunks, in the order of the rows.
+        :param max_float32_mb: Matrices up to this size in float32 are copied to memory in
+            float32, which BLAS multiplies several times faster than float16, at the cost of
+            twice the memory of the float16 file. 0 (the default) always scans the float16
+            matrix by blocks.
+        """
+        self.vectors = vectors
+        self.chunks = chunks
+        self.matrix: Optional[np.ndarray] = None
+        if 0 < vectors.size * 4 <= max_float32_mb * 1024**2:
+            self.matrix = vectors.astype(np.float32)
+
+    @classmethod
+    def build(
+        cls,
+        chunks: List[dict],
+        embeddings: List[List[float]],
+        max_float32_mb: float = 0,
+    ) -> "LocalVectorIndex":
+        if not chunks:
+            return cls(np.zeros((0, 0), dtype=np.float16), [], max_float32_mb)
+        vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(chunks), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        return cls(vectors.astype(np.float16), chunks, max_float32_mb)
+
+    @classmethod
+    def load(cls, path: str, max_float32_mb: float = 0) -> Optional["LocalVectorIndex"]:
+        """
+        :param path: Path of the files without their extension, e.g. data/{domain}.
+        :return: The index, or None if it was never saved.
+        """
+        if not os.path.exists(f"{path}.vectors.npy"):
+            return None
+        with open(f"{path}.vectors.json", "r") as f:
+            chunks = json.load(f)["chunks"]
+        vectors = np.load(f"{path}.vectors.npy", mmap_mode="r")
+        return cls(vectors, chunks, max_float32_mb)
+
+    def save(self, path: str):
+        # Write then rename, so a loaded memmap of the previous version stays valid
+        np.save(f"{path}.vectors.tmp.npy", self.vectors)
+        with open(f"{path}.vectors.tmp.json", "w") as f:
+            json.dump({"chunks": self.chunks}, f)
+        os.replace(f"{path}.vectors.tmp.json", f"{path}.vectors.json")
+        os.replace(f"{path}.vectors.tmp.npy", f"{path}.vectors.npy")
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def pages(self) -> Dict[Optional[str], Optional[str]]:
+        """
+        :return: A dictionary url -> content_hash of the indexed pages.
+        """
+        return {chunk["url"]: chunk["content_hash"] for chunk in self.chunks}
+
+    def update(
+        self,
+        urls: Set[Optional[str]],
+        chunks: List[dict],
+        embeddings: List[List[float]],
+        max_float32_mb: float = 0,
+    ) -> "LocalVectorIndex":
+        """
+        :param urls: The pages whose chunks are removed.
+        :param chunks: The new chunks.
+        :param embeddings: The embeddings of the new chunks.
+        :return: A new index with the kept and the new chunks.
+        """
+        keep = [i for i, chunk in enumerate(self.chunks) if chunk["url"] not in urls]
+        added = LocalVectorIndex.build(chunks, embeddings, max_float32_mb=0)
+        if not keep:
+            vectors = added.vectors
+        elif not chunks:
+            vectors = np.asarray(self.vectors[keep])
+        else:
+            vectors = np.concatenate([self.vectors[keep], added.vectors])
+        return LocalVectorIndex(
+            vectors, [self.chunks[i] for i in keep] + chunks, max_float32_mb
+        )
+
+    def scores(self, query: np.ndarray, block_size: int = 1024) -> np.ndarray:
+        if self.matrix is not None:
+            return self.matrix @ query
+        # float16 has no BLAS kernel: convert and multiply a block of rows at a time
+        scores = np.empty(len(self.vectors), dtype=np.float32)
+        block = np.empty((block_size, self.vectors.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.vectors), block_size):
+            rows = self.vectors[start : start + block_size]
+            np.copyto(block[: len(rows)], rows)
+            np.matmul(block[: len(rows)], query, out=scores[start : start + len(rows)])
+        return scores
+
+    def search(self, embedding: Sequence[float], limit: int) -> List[dict]:
+        """
+        :param embedding: The query embedding.
+        :param limit: Maximum number of results.
+        :return: The most similar chunks as search results, with their cosine similarity.
+        """
+        if not self.chunks:
+            return []
+        query = np.array(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        scores = self.scores(query)
+        limit = min(limit, len(scores))
+        best = np.argpartition(scores, -limit)[-limit:]
+        best = best[np.argsort(scores[best])[::-1]]
+        results = [
+            {
+                "id": self.chunks[i]["id"],
+                "text": self.chunks[i]["text"],
+                "score": float(scores[i]),
+                "embeddings": None,
+                "url": self.chunks[i]["url"],
+            }
+            for i in best
+        ]
+        logger.info(f"relevant urls: {[r['url'] for r in results]}")
+        return results